@@ -57,15 +57,23 @@ class EnterAction(Action):
         area = world.get_area(actor)
         pt = area.get_tile(actor.x, actor.y)
         if isinstance(pt, Door):
-            new_area, position = pt.get_area(world, area, (actor.x, actor.y))
-            area.add_area(new_area)
-            world.add_actor(actor, area=new_area)
-            x, y = position
-            area.remove_object(actor)
-            new_area.add_object(actor, x, y)
-            actor.notice("you have entered {}".format(pt), mood=True, entered=new_area.id)
-            actor.waypoint = None
-            new_area.broadcast(actor)
+            if world.levels and world.levels.generates(world, pt):
+                world.levels.enter(world, actor, pt, area, (actor.x, actor.y))
+                return
+            enter_door(world, actor, pt)
+
+
+def enter_door(world, actor, door):
+    area = world.get_area(actor)
+    new_area, position = door.get_area(world, area, (actor.x, actor.y))
+    area.add_area(new_area)
+    world.add_actor(actor, area=new_area)
+    x, y = position
+    area.remove_object(actor)
+    new_area.add_object(actor, x, y)
+    actor.notice("you have entered {}".format(door), mood=True, entered=new_area.id)
+    actor.waypoint = None
+    new_area.broadcast(actor)
 
 
 class ReadAction(Action):
@@ -169,9 +177,12 @@ class MeleeAttackAction(Action):
         if not self.target:
             return
 
+        # combat is announced to every player watching the attacker
+        area = world.get_area(actor)
+
         attack_roll = random.randint(1, 20)
         if attack_roll <= 1:
-            actor.notice("{} missed {}".format(actor.name, self.target.name))
+            area.publish(actor.x, actor.y, "notice", notice="{} missed {}".format(actor.name, self.target.name))
             return
 
         damage = actor.attributes.strength + (random.randint(1, actor.weapon.damage) if actor.has_weapon else 0)
@@ -184,20 +195,19 @@ class MeleeAttackAction(Action):
             damage -= self.target.shield.damage
 
         if damage <= 0:
-            actor.notice("{} did no damage to {}", actor.name, self.target.name)
+            area.publish(actor.x, actor.y, "notice", notice="{} did no damage to {}".format(actor.name, self.target.name))
             return
 
         self.target.attributes.hit_points -= damage
         self.target.hurt(actor, damage)
 
         if critical:
-            actor.notice("critical hit by {} on {} for {} damage!!!".format(actor.name, self.target.name, damage))
+            area.publish(actor.x, actor.y, "notice", notice="critical hit by {} on {} for {} damage!!!".format(actor.name, self.target.name, damage))
         else:
-            actor.notice("hit by {} on {} for {} damage!".format(actor.name, self.target.name, damage))
+            area.publish(actor.x, actor.y, "notice", notice="hit by {} on {} for {} damage!".format(actor.name, self.target.name, damage))
 
         if self.target.attributes.hit_points <= 0:
             self.target.die()
-            area = world.get_area(self.target)
             bones = Bones(name="bones of " + self.target.name)
             area.add_object(bones, self.target.x, self.target.y)
 
@@ -212,17 +222,31 @@ class MeleeAttackAction(Action):
 
             actor.stats.kills += 1
             actor.attributes.experience += self.target.attributes.experience
-            actor.notice("{} killed a {}".format(actor.name, self.target.name))
+            area.publish(actor.x, actor.y, "notice", notice="{} killed a {}".format(actor.name, self.target.name))
             world.remove_actor(self.target)
 
             from .npcs import NPC, Skeleton
 
-            def _revive():
-                area.remove_object(bones)
-                skeleton = Skeleton(name="skeleton")
-                world.add_actor(skeleton, area)
-                area.move_object(skeleton, bones.x, bones.y)
-
             if issubclass(type(self.target), NPC) and not isinstance(self.target, Skeleton):
-                world.schedule(100, _revive)
+                world.schedule(100, revive, area.id, bones.x, bones.y)
             area.broadcast(actor)
+
+
+def revive(world, area_id, x, y):
+    """
+    Raises a skeleton from the bones at a position. Bones in an area that is not loaded
+    stay bones, rather than have the area loaded, or even generated again, on the loop.
+    """
+    from .npcs import Skeleton
+    from .world import AreaRegistry
+
+    area = AreaRegistry.get(area_id)
+    if not area:
+        return
+    bones = next((obj for obj in area.get_objects(x, y) if isinstance(obj, Bones)), None)
+    if not bones:
+        return
+    area.remove_object(bones)
+    skeleton = Skeleton(name="skeleton")
+    world.add_actor(skeleton, area)
+    area.move_object(skeleton, x, y)
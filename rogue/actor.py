@@ -8,6 +8,9 @@ from .actions import Action, MeleeAttackAction, MoveAction, PickupItemAction, En
 from .tiles import Door
 from .annotations import NodeType
 
+REPAIR_DISTANCE = 8
+REPAIR_BUDGET = 200
+
 
 @dataclasses.dataclass
 class ActorState(enum.Enum):
@@ -41,6 +44,9 @@ class ActorStats:
 
 @dataclasses.dataclass
 class Actor(Object):
+    # actors with an awareness go dormant while no player is within that many tiles
+    AWARENESS = 0
+
     anchored: bool = True
     blocks: bool = True
 
@@ -52,6 +58,11 @@ class Actor(Object):
     target: Optional[Actor] = None
     waypoint: Optional[NodeType] = None
 
+    # remaining steps toward path_goal in reverse, the next step is last
+    path: List[NodeType] = dataclasses.field(default_factory=list)
+    path_goal: Optional[NodeType] = None
+    path_area: Optional[str] = None
+
     fov: List[Tuple[int, int]] = dataclasses.field(default_factory=list)
 
     def get_action(self, world) -> Optional[Action]:
@@ -93,29 +104,81 @@ class Actor(Object):
                     return ReadAction(signs[0])
 
         if self.waypoint:
-            path = area.find_path(self, self.waypoint)
-            if path:
-                x, y = path.pop(0)
+            step = self.next_step(area)
+            if step:
+                x, y = step
                 dx, dy = x - self.x, y - self.y
                 return MoveAction(dx, dy)
 
         return None
 
+    def plan_path(self, area):
+        path = area.find_path(self, self.waypoint)
+        self.path = list(reversed(path.steps))
+        self.path_goal = self.waypoint
+        self.path_area = area.id
+
+    def repair_path(self, area):
+        """
+        Detour around a blocked step back onto the path a few steps further along,
+        falling back to planning a new path
+        """
+        rejoin = max(len(self.path) - REPAIR_DISTANCE, 0)
+        target = self.path[rejoin]
+        if target != self.waypoint and area.is_tile_free(*target):
+            detour = area.find_path(self, target, max_nodes=REPAIR_BUDGET)
+            if detour.complete:
+                self.path = self.path[:rejoin] + list(reversed(detour.steps))
+                return
+        self.plan_path(area)
+
+    def next_step(self, area) -> Optional[NodeType]:
+        while self.path and self.path[-1] == self.pos:
+            self.path.pop()
+
+        stale = self.path_goal != self.waypoint or self.path_area != area.id
+        if stale or not self.path or not all(abs(self.path[-1][i] - self.pos[i]) <= 1 for i in range(0, 2)):
+            self.plan_path(area)
+        elif self.path[-1] != self.waypoint and not area.is_tile_free(*self.path[-1]):
+            self.repair_path(area)
+
+        if not self.path:
+            self.waypoint = None
+            return None
+        return self.path[-1]
+
     def get_alternate_action(self, failed_action: Action) -> Optional[Action]:
         pass
 
     def set_waypoint(self, waypoint: NodeType):
         self.waypoint = waypoint
+        self.path = []
 
     def notify(self):
         pass
 
+    def receive(self, msg):
+        pass
+
+    def flush(self):
+        pass
+
+    def wake(self, area, ticks):
+        pass
+
     @property
     def can_act(self):
         return self.attributes.energy >= self.attributes.energy_to_act
 
-    def charge_energy(self):
-        self.attributes.energy = min(self.attributes.energy + self.attributes.energy_recharge, self.attributes.max_energy)
+    @property
+    def ticks_to_act(self):
+        needed = self.attributes.energy_to_act - self.attributes.energy
+        if needed <= 0:
+            return 1
+        return -(-needed // max(self.attributes.energy_recharge, 1))
+
+    def charge_energy(self, ticks=1):
+        self.attributes.energy = min(self.attributes.energy + ticks * self.attributes.energy_recharge, self.attributes.max_energy)
 
     def drain_energy(self):
         self.attributes.energy = 0
@@ -173,11 +236,16 @@ class Player(Actor):
     """
 
     next_action: Optional[Action] = None
+    # waiting for the level behind a door to be generated
+    descending: bool = False
 
     def find_object_by_id(self, id_):
         return next((o for o in self.inventory if o.id == id_), None)
 
     def get_action(self, world):
+        if self.descending:
+            self.next_action = None
+            return None
         if self.next_action:
             rv = self.next_action
             self.next_action = None
@@ -0,0 +1,62 @@
+import hashlib
+from collections import namedtuple
+
+import numpy
+
+CHUNK_SIZE = 32
+
+
+class Chunk(namedtuple("Chunk", ["x", "y", "width", "height", "hash", "tiles"])):
+    """
+    A square of an area's terrain as a row major little endian int16 plane of tile
+    indexes, x and y being its top left corner in tiles
+    """
+
+
+class TerrainChunks(object):
+    """
+    Splits an area's terrain into fixed size chunks of tile indexes. Chunks are built
+    on first use and rebuilt after a tile inside them changed; the content hash lets
+    clients keep the ones they have seen across areas and reconnects.
+    """
+
+    def __init__(self, terrain, tileset, size=CHUNK_SIZE):
+        self.terrain = terrain
+        self.tileset = tileset
+        self.size = size
+        self.chunks = {}
+
+    def invalidate(self, x, y):
+        self.chunks.pop((x // self.size, y // self.size), None)
+
+    def covering(self, left, top, width, height):
+        """
+        Chunk coordinates of every chunk overlapping the given rectangle of the area
+        """
+        right = min(left + width, self.terrain.width) - 1
+        bottom = min(top + height, self.terrain.height) - 1
+        left, top = max(left, 0), max(top, 0)
+        return [
+            (cx, cy)
+            for cy in range(top // self.size, bottom // self.size + 1)
+            for cx in range(left // self.size, right // self.size + 1)
+        ]
+
+    def get(self, cx, cy) -> Chunk:
+        chunk = self.chunks.get((cx, cy))
+        if not chunk:
+            chunk = self.chunks[(cx, cy)] = self._build(cx, cy)
+        return chunk
+
+    def _build(self, cx, cy):
+        left, top = cx * self.size, cy * self.size
+        right = min(left + self.size, self.terrain.width)
+        bottom = min(top + self.size, self.terrain.height)
+
+        indexes = numpy.array([self.tileset.get_index(key) for key in self.terrain.keys], dtype="<i2")
+        tiles = indexes[self.terrain.key_ids[top:bottom, left:right]].tobytes()
+
+        width, height = right - left, bottom - top
+        digest = hashlib.blake2b("{}x{}".format(width, height).encode(), digest_size=8)
+        digest.update(tiles)
+        return Chunk(left, top, width, height, digest.hexdigest(), tiles)
@@ -0,0 +1,154 @@
+from typing import Optional
+
+import numpy
+
+from .annotations import NodeType
+
+# http://www.roguebasin.com/index.php?title=The_Incredible_Power_of_Dijkstra_Maps
+
+FLOW_RADIUS = 24
+FLEE_FACTOR = -1.2
+# at most FLOW_RESCANS players that moved get their square rescanned per tick, the
+# others keep the one from where they were a little longer
+FLOW_RESCANS = 4
+
+NEIGHBORS = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]
+
+
+def _relax(values, passable, iterations):
+    """
+    Lowers every passable cell to one more than its lowest neighbor until nothing
+    changes, at most the given number of times
+    """
+    height, width = values.shape
+    padded = numpy.full((height + 2, width + 2), numpy.inf, dtype=values.dtype)
+    for _ in range(iterations):
+        padded[1:-1, 1:-1] = values
+        lowest = numpy.minimum.reduce([
+            padded[1 + dy:height + 1 + dy, 1 + dx:width + 1 + dx] for dx, dy in NEIGHBORS
+        ])
+        relaxed = numpy.where(passable, numpy.minimum(values, lowest + 1), values)
+        if numpy.array_equal(relaxed, values):
+            break
+        values = relaxed
+    return values
+
+
+class DijkstraMap(object):
+    """
+    Distances to the nearest goal for every cell of an area, infinite where out of
+    reach. Actors follow it by stepping to the lowest free neighbor.
+    """
+
+    def __init__(self, values: numpy.ndarray):
+        self.values = values
+
+    def get(self, x, y):
+        value = self.values[y, x]
+        return None if numpy.isinf(value) else float(value)
+
+    def downhill(self, area, actor) -> Optional[NodeType]:
+        height, width = self.values.shape
+        best = self.values[actor.y, actor.x]
+        if numpy.isinf(best):
+            return None
+
+        rv = None
+        for dx, dy in NEIGHBORS:
+            x = actor.x + dx
+            y = actor.y + dy
+            if x < 0 or x >= width or y < 0 or y >= height:
+                continue
+            value = self.values[y, x]
+            if value < best and area.is_tile_free(x, y):
+                best = value
+                rv = dx, dy
+        return rv
+
+    def inverted(self, passable, iterations, factor=FLEE_FACTOR):
+        """
+        Scales the map by a negative factor and rescans it, so that following it leads
+        away from the goals without running into dead ends
+        """
+        reachable = ~numpy.isinf(self.values)
+        values = numpy.where(reachable, self.values * factor, numpy.inf)
+        rows, cols = numpy.nonzero(reachable)
+        if not len(rows):
+            return DijkstraMap(values)
+
+        top, bottom, left, right = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+        window = (slice(top, bottom), slice(left, right))
+        values[window] = _relax(values[window], passable[window] & reachable[window], iterations)
+        return DijkstraMap(values)
+
+
+class FlowField(object):
+    """
+    Dijkstra maps toward every player in an area, shared by all of its actors. Each
+    player only contributes the square within max_radius around it, kept until the
+    player moves. At most once per tick the squares of up to max_rescans players that
+    moved are scanned again, longest waiting first, and merged with the others.
+    """
+
+    def __init__(self, area, max_radius=FLOW_RADIUS, max_rescans=FLOW_RESCANS):
+        self.area = area
+        self.max_radius = max_radius
+        self.max_rescans = max_rescans
+        # id(player) -> (position, area time scanned at, bounds, window)
+        self.windows = {}
+        self.updated_at = None
+        self.chase_map = None
+        self.flee_map = None
+
+    @property
+    def passable(self):
+        return ~self.area.terrain.blocked
+
+    def refresh(self):
+        if self.updated_at == self.area.time:
+            return
+        self.updated_at = self.area.time
+
+        players = {id(player): player.pos for player in self.area.players}
+        gone = [key for key in self.windows if key not in players]
+        for key in gone:
+            del self.windows[key]
+
+        moved = [key for key, pos in players.items() if key not in self.windows or self.windows[key][0] != pos]
+        moved.sort(key=lambda key: self.windows[key][1] if key in self.windows else -1)
+        for key in moved[:self.max_rescans]:
+            pos = players[key]
+            self.windows[key] = (pos, self.area.time) + self._scan(*pos)
+
+        if gone or moved or not self.chase_map:
+            self.chase_map = DijkstraMap(self._merge())
+            self.flee_map = None
+
+    def _scan(self, x, y):
+        terrain = self.area.terrain
+        r = self.max_radius
+        left, top = max(x - r, 0), max(y - r, 0)
+        right, bottom = min(x + r + 1, terrain.width), min(y + r + 1, terrain.height)
+
+        # every cell within r steps lies inside the square so the window is exact
+        window = numpy.full((bottom - top, right - left), numpy.inf, dtype=numpy.float32)
+        window[y - top, x - left] = 0
+        window = _relax(window, ~terrain.blocked[top:bottom, left:right], r)
+        return (slice(top, bottom), slice(left, right)), window
+
+    def _merge(self):
+        terrain = self.area.terrain
+        values = numpy.full((terrain.height, terrain.width), numpy.inf, dtype=numpy.float32)
+        for _, _, bounds, window in self.windows.values():
+            numpy.minimum(values[bounds], window, out=values[bounds])
+        return values
+
+    def chase(self) -> DijkstraMap:
+        self.refresh()
+        return self.chase_map
+
+    def flee(self) -> DijkstraMap:
+        self.refresh()
+        if not self.flee_map:
+            self.flee_map = self.chase_map.inverted(self.passable, self.max_radius)
+        return self.flee_map
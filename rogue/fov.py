@@ -0,0 +1,99 @@
+from typing import Callable
+
+# https://www.albertford.com/shadowcasting/
+#
+# Symmetric shadowcasting over a flat opacity buffer. Slopes are kept as integer
+# (numerator, denominator) pairs so the scan needs no floats or fractions.
+
+QUADRANTS = (
+    # (col dx, col dy, depth dx, depth dy)
+    (1, 0, 0, -1),  # north
+    (0, 1, 1, 0),   # east
+    (1, 0, 0, 1),   # south
+    (0, 1, -1, 0),  # west
+)
+
+
+class FieldOfView(object):
+    """
+    Visibility mask for the square of side 2 * radius + 1 centered on the origin.
+    """
+
+    def __init__(self, x, y, radius):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.left = x - radius
+        self.top = y - radius
+        self.size = 2 * radius + 1
+        self.mask = bytearray(self.size * self.size)
+
+    def __contains__(self, pos):
+        x, y = pos
+        return self.is_visible(x, y)
+
+    def is_visible(self, x, y):
+        mx = x - self.left
+        my = y - self.top
+        if mx < 0 or mx >= self.size or my < 0 or my >= self.size:
+            return False
+        return self.mask[my * self.size + mx] == 1
+
+    def reveal(self, x, y):
+        self.mask[(y - self.top) * self.size + (x - self.left)] = 1
+
+
+def compute_fov(opaque: bytearray, width: int, height: int, x: int, y: int, radius: int,
+                is_blocker: Callable[[int, int], bool] = None) -> FieldOfView:
+    """
+    Computes the field of view from (x, y) over a row major opacity buffer of the given
+    width and height. Cells outside of the buffer are opaque and never revealed.
+    is_blocker is an optional extra opacity test, e.g. for objects blocking sight.
+    """
+
+    fov = FieldOfView(x, y, radius)
+    fov.reveal(x, y)
+
+    mask = fov.mask
+    size = fov.size
+    left = fov.left
+    top = fov.top
+    radius_squared = radius * radius + radius
+
+    for col_x, col_y, row_x, row_y in QUADRANTS:
+
+        # rows are (depth, start numerator, start denominator, end numerator, end denominator)
+        rows = [(1, -1, 1, 1, 1)]
+        while rows:
+            depth, start_n, start_d, end_n, end_d = rows.pop()
+            if depth > radius:
+                continue
+
+            # round half up of depth * start, round half down of depth * end
+            min_col = (2 * depth * start_n + start_d) // (2 * start_d)
+            max_col = -((end_d - 2 * depth * end_n) // (2 * end_d))
+
+            prev_opaque = None
+            for col in range(min_col, max_col + 1):
+                cx = x + col * col_x + depth * row_x
+                cy = y + col * col_y + depth * row_y
+                in_bounds = 0 <= cx < width and 0 <= cy < height
+                if in_bounds:
+                    is_opaque = opaque[cy * width + cx] or (is_blocker is not None and is_blocker(cx, cy))
+                else:
+                    is_opaque = True
+
+                if in_bounds and (is_opaque or (col * start_d >= depth * start_n and col * end_d <= depth * end_n)):
+                    if col * col + depth * depth <= radius_squared:
+                        mask[(cy - top) * size + (cx - left)] = 1
+
+                if prev_opaque and not is_opaque:
+                    start_n, start_d = 2 * col - 1, 2 * depth
+                elif prev_opaque is not None and not prev_opaque and is_opaque:
+                    rows.append((depth + 1, start_n, start_d, 2 * col - 1, 2 * depth))
+                prev_opaque = is_opaque
+
+            if prev_opaque is not None and not prev_opaque:
+                rows.append((depth + 1, start_n, start_d, end_n, end_d))
+
+    return fov
@@ -0,0 +1,228 @@
+import heapq
+import collections
+import logging
+from typing import Dict, List, Optional
+
+from .annotations import NodeType
+
+# https://webdocs.cs.ualberta.ca/~mmueller/ps/hpastar.pdf
+
+CLUSTER_SIZE = 16
+MAX_ENTRANCE_WIDTH = 6
+
+log = logging.getLogger(__name__)
+
+ClusterType = NodeType
+
+
+def _distance(a: NodeType, b: NodeType) -> int:
+    return max(abs(b[0] - a[0]), abs(b[1] - a[1]))
+
+
+class ClusterGraph(object):
+    """
+    Abstract graph over an area's static terrain. The area is partitioned into square
+    clusters, portals are placed on the walkable stretches of each border between two
+    clusters and every pair of portals within a cluster is joined by its walking distance.
+    Objects are ignored here, they are left to the low level search refining each leg.
+    """
+
+    def __init__(self, terrain, size=CLUSTER_SIZE):
+        self.terrain = terrain
+        self.size = size
+        self.clusters_wide = -(-terrain.width // size)
+        self.clusters_tall = -(-terrain.height // size)
+
+        # (cluster, neighbor) -> [(portal in cluster, portal in neighbor)]
+        self.borders: Dict[ClusterType, List] = {}
+        # cluster -> portal -> {portal: distance}
+        self.intra: Dict[ClusterType, Dict[NodeType, Dict[NodeType, int]]] = {}
+        # portal -> portals across a border
+        self.inter: Dict[NodeType, List[NodeType]] = collections.defaultdict(list)
+
+        self.dirty = set()
+
+    @property
+    def clusters(self):
+        return [(cx, cy) for cy in range(self.clusters_tall) for cx in range(self.clusters_wide)]
+
+    def build(self):
+        self.dirty = set(self.clusters)
+        self.refresh()
+
+    def cluster_of(self, x, y) -> ClusterType:
+        return x // self.size, y // self.size
+
+    def bounds(self, cluster):
+        cx, cy = cluster
+        left, top = cx * self.size, cy * self.size
+        return left, top, min(left + self.size, self.terrain.width), min(top + self.size, self.terrain.height)
+
+    def neighbors(self, cluster):
+        cx, cy = cluster
+        for nx, ny in ((cx - 1, cy), (cx + 1, cy), (cx, cy - 1), (cx, cy + 1)):
+            if 0 <= nx < self.clusters_wide and 0 <= ny < self.clusters_tall:
+                yield nx, ny
+
+    def invalidate(self, x, y):
+        self.dirty.add(self.cluster_of(x, y))
+
+    def refresh(self):
+        if not self.dirty:
+            return
+
+        dirty, self.dirty = self.dirty, set()
+        for cluster in dirty:
+            for neighbor in self.neighbors(cluster):
+                key = (cluster, neighbor) if cluster < neighbor else (neighbor, cluster)
+                self.borders[key] = self._find_entrances(*key)
+
+        self.inter = collections.defaultdict(list)
+        for transitions in self.borders.values():
+            for a, b in transitions:
+                self.inter[a].append(b)
+                self.inter[b].append(a)
+
+        touched = set(dirty)
+        for cluster in dirty:
+            touched.update(self.neighbors(cluster))
+        for cluster in touched:
+            portals = self.portals(cluster)
+            self.intra[cluster] = {portal: self._distances(cluster, portal, portals) for portal in portals}
+
+    def portals(self, cluster):
+        rv = set()
+        for neighbor in self.neighbors(cluster):
+            if cluster < neighbor:
+                rv.update(a for a, _ in self.borders.get((cluster, neighbor), []))
+            else:
+                rv.update(b for _, b in self.borders.get((neighbor, cluster), []))
+        return rv
+
+    def _find_entrances(self, cluster, neighbor):
+        blocked = self.terrain.is_blocked
+        left, top, right, bottom = self.bounds(cluster)
+        horizontal = neighbor[0] != cluster[0]
+        if horizontal:
+            span = range(top, bottom)
+
+            def _cells(i):
+                return (right - 1, i), (right, i)
+        else:
+            span = range(left, right)
+
+            def _cells(i):
+                return (i, bottom - 1), (i, bottom)
+
+        def _crossing(i):
+            a, b = _cells(i)
+            if blocked(*a):
+                return None
+            for j in (i, i - 1, i + 1):
+                if j in span:
+                    b = _cells(j)[1]
+                    if not blocked(*b):
+                        return a, b
+            return None
+
+        transitions = []
+        run = []
+        for i in list(span) + [None]:
+            crossing = _crossing(i) if i is not None else None
+            if crossing:
+                run.append(crossing)
+                continue
+            if run:
+                if len(run) < MAX_ENTRANCE_WIDTH:
+                    transitions.append(run[len(run) // 2])
+                else:
+                    transitions.extend((run[0], run[-1]))
+                run = []
+        return transitions
+
+    def _distances(self, cluster, origin, targets):
+        """
+        Breadth first search from origin restricted to the cluster, returning the
+        distances to any reachable targets
+        """
+        blocked = self.terrain.is_blocked
+        left, top, right, bottom = self.bounds(cluster)
+
+        rv = {}
+        distances = {origin: 0}
+        queue = collections.deque([origin])
+        while queue:
+            node = queue.popleft()
+            distance = distances[node]
+            if node in targets and node != origin:
+                rv[node] = distance
+            x, y = node
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    neighbor = (x + dx, y + dy)
+                    nx, ny = neighbor
+                    if not (left <= nx < right and top <= ny < bottom):
+                        continue
+                    if neighbor in distances or blocked(nx, ny):
+                        continue
+                    distances[neighbor] = distance + 1
+                    queue.append(neighbor)
+        return rv
+
+    def find_route(self, start: NodeType, goal: NodeType) -> Optional[List[NodeType]]:
+        """
+        Searches the abstract graph for a list of portals leading from start to goal,
+        including both, or None if there is no route
+        """
+        self.refresh()
+
+        start_cluster = self.cluster_of(*start)
+        goal_cluster = self.cluster_of(*goal)
+        start_portals = self.portals(start_cluster)
+        goal_portals = self.portals(goal_cluster)
+        start_edges = self._distances(start_cluster, start, start_portals)
+        goal_edges = self._distances(goal_cluster, goal, goal_portals)
+        # a start or goal on a portal is connected through it even when no other
+        # portal of its cluster is reachable
+        if start in start_portals:
+            start_edges[start] = 0
+        if goal in goal_portals:
+            goal_edges[goal] = 0
+        if not start_edges or not goal_edges:
+            return None
+
+        def _edges(node):
+            yield from start_edges.items() if node == start else ()
+            for other, distance in self.intra.get(self.cluster_of(*node), {}).get(node, {}).items():
+                yield other, distance
+            for other in self.inter.get(node, ()):
+                yield other, 1
+            if node in goal_edges:
+                yield goal, goal_edges[node]
+
+        came_from = {}
+        score = {start: 0}
+        open_nodes = [(_distance(start, goal), start)]
+        closed = set()
+        while open_nodes:
+            _, node = heapq.heappop(open_nodes)
+            if node == goal:
+                route = [node]
+                while node in came_from:
+                    node = came_from[node]
+                    route.append(node)
+                return list(reversed(route))
+
+            if node in closed:
+                continue
+            closed.add(node)
+
+            for other, distance in _edges(node):
+                new_score = score[node] + distance
+                if other in closed or new_score >= score.get(other, new_score + 1):
+                    continue
+                came_from[other] = node
+                score[other] = new_score
+                heapq.heappush(open_nodes, (new_score + _distance(other, goal), other))
+
+        return None
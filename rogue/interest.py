@@ -0,0 +1,65 @@
+import collections
+
+INTEREST_CELL = 16
+
+
+class InterestGrid(object):
+    """
+    Coarse grid of which players observe which part of an area. A player subscribes
+    to every cell its view square overlaps, so events at a position only need to be
+    checked against the players of a single cell.
+    """
+
+    def __init__(self, size=INTEREST_CELL):
+        self.size = size
+        # cell -> {id(player): player}
+        self.cells = collections.defaultdict(dict)
+        # id(player) -> (x, y, radius, cells)
+        self.views = {}
+
+    def update(self, player, radius):
+        key = id(player)
+        view = self.views.get(key)
+        if view and view[:3] == (player.x, player.y, radius):
+            return
+
+        size = self.size
+        cells = {
+            (cx, cy)
+            for cy in range((player.y - radius) // size, (player.y + radius) // size + 1)
+            for cx in range((player.x - radius) // size, (player.x + radius) // size + 1)
+        }
+        old_cells = view[3] if view else set()
+        for cell in old_cells - cells:
+            subscribers = self.cells[cell]
+            subscribers.pop(key, None)
+            if not subscribers:
+                del self.cells[cell]
+        for cell in cells - old_cells:
+            self.cells[cell][key] = player
+        self.views[key] = (player.x, player.y, radius, cells)
+
+    def remove(self, player):
+        view = self.views.pop(id(player), None)
+        if not view:
+            return
+        for cell in view[3]:
+            subscribers = self.cells[cell]
+            subscribers.pop(id(player), None)
+            if not subscribers:
+                del self.cells[cell]
+
+    def observers(self, x, y):
+        """
+        Players whose view contains the position
+        """
+        subscribers = self.cells.get((x // self.size, y // self.size))
+        if not subscribers:
+            return []
+        views = self.views
+        rv = []
+        for key, player in subscribers.items():
+            vx, vy, radius, _ = views[key]
+            if abs(vx - x) <= radius and abs(vy - y) <= radius:
+                rv.append(player)
+        return rv
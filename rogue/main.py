@@ -1,7 +1,9 @@
 import os
 import argparse
 import asyncio
+import concurrent.futures
 import logging
+import multiprocessing
 import sys
 import time
 import random
@@ -9,25 +11,47 @@ import random
 import uvicorn
 from jinja2 import Environment, PackageLoader, select_autoescape
 
-from . import procgen
+from . import procgen, snapshot
 from .server import app
+from .storage import AreaStore
 from .tiles import TileSet
 from .world import DAY, TIMEOUT
 
 MAP_SIZE = 200
+LEVEL_WORKERS = 2
 TILESET_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "tileset.yaml")
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), "..", "snapshots", "world.snapshot")
 
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] %(levelname)s/%(name)s - %(message)s')
 log = logging.getLogger(__name__)
 
 
-def create_app():
+def load_world(store):
+    if os.path.exists(SNAPSHOT_PATH):
+        start = time.perf_counter()
+        try:
+            world = snapshot.restore(SNAPSHOT_PATH, store)
+            log.info("restored world at age %s in %.3fs", world.age, time.perf_counter() - start)
+            return world
+        except Exception:
+            log.exception("could not restore world from %s", SNAPSHOT_PATH)
 
     seed = int(time.time())
 
     log.info("starting world with seed %s", seed)
     random.seed(seed)
     world = procgen.generate_world(MAP_SIZE)
+    world.store = store
+    return world
+
+
+def create_app():
+
+    world = load_world(AreaStore())
+    # workers are started from a fork server rather than forked from the threaded server
+    world.levels.executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=LEVEL_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    snapshots = snapshot.Snapshots(SNAPSHOT_PATH)
     tileset = TileSet(TILESET_PATH)
 
     app.state.world = world
@@ -42,11 +66,11 @@ def create_app():
 
         while True:
             world.tick()
+            snapshots.poll(world)
 
             day, mod = divmod(world.age, DAY)
             if not mod:
-                for player in world.players:
-                    player.notice("day {}".format(day))
+                world.publish("notice", notice="day {}".format(day))
 
             await asyncio.sleep(TIMEOUT)
 
@@ -58,5 +82,7 @@ def create_app():
     @app.on_event("shutdown")
     async def shutdown():
         log.info("server shutdown...")
+        world.levels.executor.shutdown(wait=False, cancel_futures=True)
+        snapshots.close(world)
 
     return app
@@ -0,0 +1,33 @@
+import msgpack
+
+
+class SharedMessage(object):
+    """
+    A message delivered to many players at once, e.g. an area event or a world
+    announcement. It is encoded the first time a writer needs it and every queue
+    holding it sends those same bytes.
+    """
+
+    __slots__ = ("msg", "_data")
+
+    def __init__(self, msg):
+        self.msg = msg
+        self._data = None
+
+    def __getitem__(self, key):
+        return self.msg[key]
+
+    def get(self, key, default=None):
+        return self.msg.get(key, default)
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = msgpack.packb(self.msg)
+        return self._data
+
+
+def pack(msg) -> bytes:
+    if isinstance(msg, SharedMessage):
+        return msg.data
+    return msgpack.packb(msg)
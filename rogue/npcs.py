@@ -8,11 +8,16 @@ from .objects import Coin, Item, Equipment
 
 log = logging.getLogger(__name__)
 
+AWARENESS_RADIUS = 24
+CATCHUP_STEPS = 16
+FLEE_HEALTH = .25
+
 
 @dataclasses.dataclass(init=False)
 class NPC(Actor):
     KEY = None
     NAME = None
+    AWARENESS = AWARENESS_RADIUS
 
     def __init__(self, *args, **kwargs):
         if "name" not in kwargs:
@@ -22,6 +27,22 @@ class NPC(Actor):
     def hurt(self, actor, damage):
         self.target = actor
 
+    def wake(self, area, ticks):
+        """
+        Catch up on the time spent dormant with a short random walk
+        """
+        steps = min(ticks * self.attributes.energy_recharge // self.attributes.energy_to_act, CATCHUP_STEPS)
+        for _ in range(steps):
+            x = self.x + random.randint(-1, 1)
+            y = self.y + random.randint(-1, 1)
+            if area.is_tile_free(x, y):
+                area.move_object(self, x, y)
+
+    def get_flow(self, area):
+        if self.attributes.hit_points < self.attributes.health * FLEE_HEALTH:
+            return area.flow_field.flee()
+        return area.flow_field.chase()
+
     def get_action(self, world):
         if not self.target:
             for actor in world.surrounding_actors(self):
@@ -37,6 +58,10 @@ class NPC(Actor):
         else:
             action = None
 
+            step = self.get_flow(area).downhill(area, self)
+            if step:
+                return MoveAction(*step)
+
             for _ in range(10):
                 dx, dy = random.randint(-1, 1), random.randint(-1, 1)
                 x = self.x + dx
@@ -1,11 +1,19 @@
+import abc
 import random
 import noise
 import collections
+import concurrent.futures
+import functools
+import hashlib
 import logging
 from enum import Enum
 
-from .world import World, Area
-from .tiles import Door, Tile, Trap
+import numpy
+
+from .world import World, Area, AreaRegistry
+from .actor import Actor
+from .actions import enter_door
+from .tiles import Door, Tile, Trap, TileGrid
 from .objects import Coin, Shield, Sword, HealthPotion, Box, Sign
 from .npcs import Orc
 
@@ -15,8 +23,39 @@ NUM_COINS = 100
 NUM_ITEMS = 100
 NUM_TRAPS = 100
 
+# levels generated at once, further doors wait for a free slot
+GENERATION_LIMIT = 2
+
+# levels behind doors within WARM_DISTANCE of a player are generated ahead of time
+# every WARM_INTERVAL ticks, WARM_JOBS at once, keeping at most WARM_LEVELS of them
+WARM_DISTANCE = 16
+WARM_INTERVAL = 10
+WARM_JOBS = 1
+WARM_LEVELS = 8
+
 COIN_KEYS = ["coin1", "coin2", "coin3", "coin4", "coin5"]
 
+# overworld terrain by normalized height, each band below its upper bound
+TERRAIN_BANDS = [
+    (.1, Tile("water3", blocked=True)),
+    (.2, Tile("water2", blocked=True)),
+    (.3, Tile("water1", blocked=True)),
+    (.4, Tile("sand1")),
+    (.45, Tile("sand2")),
+    (.5, Tile("sand3")),
+    (.6, Tile("grass1")),
+    (.8, Tile("grass2")),
+    (.95, Tile("grass3")),
+    (None, Tile("mountains1", blocked=True)),
+]
+BORDER_BAND = 2
+
+# cave automaton: initial floor ratio and the counts of wall neighbors for which a
+# floor cell turns to wall and a wall cell stays one
+CAVE_FILL = .45
+CAVE_BIRTH = (6, 7, 8)
+CAVE_SURVIVAL = (4, 5, 6, 7, 8)
+
 log = logging.getLogger(__name__)
 
 
@@ -24,176 +63,404 @@ def dump_tiles(tiles):
     pass
 
 
-def add_doors(door_class, tiles, total_doors=NUM_DOORS, depth=0, key="crypt1"):
-    width = len(tiles[0])
-    height = len(tiles)
+def derive_rng(rng):
+    """
+    A stream seeded from the state of rng without drawing from it, so that what is
+    generated from it leaves the later draws of rng as they were
+    """
+    return random.Random(hashlib.sha256(repr(rng.getstate()).encode()).digest())
+
+
+def add_doors(door_class, tiles, total_doors=NUM_DOORS, depth=0, key="crypt1", rng=random):
+    # door seeds do not come from rng, which places the doors and everything after them
+    seeds = derive_rng(rng)
     num_doors = 0
     while num_doors < total_doors:
-        dx = random.randrange(0, width)
-        dy = random.randrange(0, height)
-        tile = tiles[dy][dx]
-        if not tile.blocked:
-            tiles[dy][dx] = door_class(key, depth=depth)
+        dx = rng.randrange(0, tiles.width)
+        dy = rng.randrange(0, tiles.height)
+        if not tiles.is_blocked(dx, dy):
+            tiles.set(dx, dy, door_class(key, depth=depth, seed=seeds.getrandbits(64)))
             num_doors += 1
 
 
-def add_npcs(world, area, num_npcs=NUM_NPCS):
+def add_npcs(world, area, num_npcs=NUM_NPCS, rng=random):
     for i in range(num_npcs):
         npc = Orc(name="orc.{}".format(i))
-        world.place_actor(npc, area=area)
+        world.place_actor(npc, area=area, rng=rng)
 
 
-def add_coins(area, num_coins=NUM_COINS):
+def add_coins(area, num_coins=NUM_COINS, rng=random):
     for _ in range(num_coins):
-        c = Coin(random.choice(COIN_KEYS))
-        area.place(c)
+        c = Coin(rng.choice(COIN_KEYS))
+        area.place(c, rng)
 
 
-def add_items(area, num_items=NUM_ITEMS):
+def add_items(area, num_items=NUM_ITEMS, rng=random):
     for _ in range(num_items):
-        area.place(Sword("sword1"))
-        area.place(Shield("shield1"))
-        area.place(HealthPotion("potion1"))
-        area.place(Box("chest1", contains=[Coin("coin1")]))
-        area.place(Sign("sign1", message="hello"))
+        area.place(Sword("sword1"), rng)
+        area.place(Shield("shield1"), rng)
+        area.place(HealthPotion("potion1"), rng)
+        area.place(Box("chest1", contains=[Coin("coin1")]), rng)
+        area.place(Sign("sign1", message="hello"), rng)
 
 
-def add_traps(area, num_traps=NUM_TRAPS):
-    width = len(area.tiles[0])
-    height = len(area.tiles)
+def add_traps(area, num_traps=NUM_TRAPS, rng=random):
     count = 0
     while count < num_traps:
-        dx = random.randrange(0, width)
-        dy = random.randrange(0, height)
-        tile = area.tiles[dy][dx]
+        dx = rng.randrange(0, area.map_width)
+        dy = rng.randrange(0, area.map_height)
+        tile = area.get_tile(dx, dy)
         if not tile.blocked:
-            area.tiles[dy][dx] = Trap(tile.key)
+            area.set_tile(dx, dy, Trap(tile.key))
             count += 1
 
 
-def populate_area(world, area):
-    add_npcs(world, area)
-    add_coins(area)
-    add_items(area)
-    add_traps(area)
+def populate_area(world, area, rng=random):
+    add_npcs(world, area, rng=rng)
+    add_coins(area, rng=rng)
+    add_items(area, rng=rng)
+    add_traps(area, rng=rng)
+    area.build_path_graph()
 
 
-def generate_cave(width, height, iterations=5, depth=0):
-    current_step = [[True for _ in range(width)] for __ in range(height)]
+class Level(collections.namedtuple("Level", ["tiles", "position", "spawns", "path_graph"])):
+    """
+    A level generated for a door: its terrain, where the way back up goes, the
+    objects to spawn as (object, x, y) and its path graph
+    """
 
-    num_floor = int(round(width * height * .45))
-    while num_floor > 0:
-        x = random.randrange(1, width - 1)
-        y = random.randrange(1, height - 1)
-        if current_step[y][x]:
-            current_step[y][x] = False
-            num_floor -= 1
 
-    def _cell(x, y):
+def generate_level(door_class, depth, seed) -> Level:
+    """
+    Generates and populates the level behind a door on a scratch area, without a
+    world, so that it can run in a worker process. Everything is drawn from a stream
+    seeded with the door's seed, the same seed always yields the same level.
+    """
+    rng = random.Random(seed)
+    tiles = door_class.generate_tiles(depth, rng)
 
-        num_neighbors = 0
-        for i in range(-1, 2):
-            for j in range(-1, 2):
+    while True:
+        x = rng.randrange(0, tiles.width)
+        y = rng.randrange(0, tiles.height)
+        if not tiles.is_blocked(x, y):
+            # stands in for the stairs until the level is attached to the door
+            tiles.set(x, y, Door("stairsup1"))
+            break
 
-                if (i, j) == (0, 0):
-                    continue
+    area = Area(door_class.NAME, tiles, depth)
+    AreaRegistry.pop(area.id)
+    for i in range(NUM_NPCS):
+        area.place(Orc(name="orc.{}".format(i)), rng)
+    add_coins(area, rng=rng)
+    add_items(area, rng=rng)
+    add_traps(area, rng=rng)
+    area.build_path_graph()
 
-                cx = x + j
-                cy = y + i
-                if cx < 0 or cx >= width or cy < 0 or cy >= height:
-                    continue
+    return Level(tiles, (x, y), [(obj, obj.x, obj.y) for obj in area.objects], area.path_graph)
 
-                if current_step[cy][cx]:
-                    num_neighbors += 1
 
-        if num_neighbors > 5:
-            return True
-        elif num_neighbors < 4:
-            return False
-        else:
-            return current_step[y][x]
+class LevelDoor(Door, metaclass=abc.ABCMeta):
+    """
+    A door to a level that is generated from the door's seed the first time someone
+    enters it
+    """
 
-    for _ in range(iterations):
-        current_step = [[_cell(x, y) for y in range(width)] for x in range(height)]
+    NAME = "Level"
 
-    def _tile(pos, cell):
-        x, y = pos
-        if x == 0 or y == 0 or x == width - 1 or y == height - 1:
-            return Tile("wall3", blocked=True, blocked_sight=True)
-        return Tile("wall3", blocked=True, blocked_sight=True) if cell else Tile("grey3")
+    def __init__(self, *args, **kwargs):
+        self.depth = kwargs.pop("depth", 0)
+        self.seed = kwargs.pop("seed", None)
+        if self.seed is None:
+            self.seed = random.getrandbits(64)
+        kwargs["message"] = "{} level {}".format(self.NAME.lower(), self.depth)
+        super(LevelDoor, self).__init__(*args, **kwargs)
 
-    tiles = [[_tile((x, y), cell) for x, cell in enumerate(row)] for y, row in enumerate(current_step)]
-    add_doors(CaveDoor, tiles, NUM_DOORS, depth=depth, key="crypt1")
-    return tiles
+    @classmethod
+    @abc.abstractmethod
+    def generate_tiles(cls, depth, rng) -> TileGrid:
+        pass
 
+    @property
+    def exit_message(self):
+        if self.depth > 1:
+            return "a door to {} level {}".format(self.NAME.lower(), self.depth - 1)
+        return "an exit to the world"
+
+    def build_area(self, world, level, exit_area, exit_position):
+        """
+        Attaches a generated level to the door
+        """
+        area = self._attach(world, level, exit_area.id, exit_position)
+        exit_area.record("door", exit_position[0], exit_position[1], area.id, level.position)
+
+    @classmethod
+    def rebuild_area(cls, world, level, origin, area_id, journal):
+        """
+        Brings back the area of a level that was dropped down to its seed under its old
+        id, from the level generated again and the journal of the area
+        """
+        _, depth, seed, exit_area_id, exit_position = origin
+        door = cls(None, depth=depth, seed=seed)
+        return door._attach(world, level, exit_area_id, exit_position, journal, area_id)
+
+    def _attach(self, world, level, exit_area_id, exit_position, journal=(), area_id=None):
+        area = Area(self.NAME, level.tiles, self.depth, area_id=area_id)
+        area.origin = (type(self), self.depth, self.seed, exit_area_id, exit_position)
+        x, y = level.position
+        area.set_tile(x, y, Door("stairsup1", area_id=exit_area_id, position=exit_position, message=self.exit_message))
+        area.path_graph = level.path_graph
+
+        taken = {entry[1] for entry in journal if entry[0] == "taken"}
+        for spawn, (obj, ox, oy) in enumerate(level.spawns):
+            if spawn in taken:
+                continue
+            if isinstance(obj, Actor):
+                obj.stats.born = world.age
+                world.add_actor(obj, area=area)
+            area.add_object(obj, ox, oy)
+            area.spawns[id(obj)] = spawn
+
+        replay_journal(area, journal)
+        if area not in world.areas:
+            world.areas.append(area)
+        self.area_id, self.position = area.id, level.position
+        return area
 
-class CaveDoor(Door):
+    def get_area(self, world, exit_area, exit_position):
+        if not self.area_id:
+            log.info("generating %s...", self.NAME.lower())
+            level = generate_level(type(self), self.depth, self.seed)
+            self.build_area(world, level, exit_area, exit_position)
+            log.info("%s done!", self.NAME.lower())
+        return super(LevelDoor, self).get_area(world, exit_area, exit_position)
+
+
+def replay_journal(area, journal):
+    """
+    Applies the mutations journaled by an area to one freshly generated from the same
+    seed. Taken spawns are left out when the area is populated, traps are sprung again
+    and doors lead to the levels that were generated behind them again.
+    """
+    for entry in journal:
+        if entry[0] == "trap":
+            _, x, y = entry
+            area.get_tile(x, y).spring(area, x, y)
+        elif entry[0] == "door":
+            _, x, y, area_id, position = entry
+            door = area.get_tile(x, y)
+            door.area_id, door.position = area_id, position
+    area.journal = list(journal)
+
+
+class LevelGenerator(object):
+    """
+    Generates the levels behind doors off the game loop, in the executor when there
+    is one. Players entering a door to a level that does not exist yet, or that the
+    store dropped down to its seed, wait descending until it is built, at most limit
+    levels are generated at once and the other doors wait for their turn.
+
+    Spare capacity goes to warming up the levels behind unopened doors near players.
+    Those are kept unpopulated, at most warm_levels of them with the least recently
+    wanted dropped first, so entering them takes no time.
+    """
+
+    def __init__(self, executor=None, limit=GENERATION_LIMIT, warm_distance=WARM_DISTANCE,
+                 warm_levels=WARM_LEVELS, warm_jobs=WARM_JOBS):
+        self.executor = executor
+        self.limit = limit
+        # seed of the door to a new level or id of a level dropped down to its seed ->
+        # the arguments to generate_level, what builds the area from the level and the
+        # id of the area the door is in. Doors are not keyed by id, a door freed with
+        # its unloaded area may leave its id to another one.
+        self.doors = {}
+        self.queued = collections.deque()
+        self.jobs = {}
+        # key -> [(player, door, area)] of the players waiting on the level
+        self.waiting = collections.defaultdict(list)
+
+        self.warm_distance = warm_distance
+        self.warm_levels = warm_levels
+        self.warm_jobs = warm_jobs
+        # door seed -> (id of the area the door is in, level), least recently wanted
+        # first, dropped when the area is unloaded
+        self.warm = collections.OrderedDict()
+        self.speculative = set()
+
+    def generates(self, world, door):
+        """
+        Whether the level behind a door has to be generated before it can be entered
+        """
+        if not door.area_id:
+            return isinstance(door, LevelDoor)
+        return bool(world.store) and door.area_id in world.store.origins
+
+    def enter(self, world, player, door, area, position):
+        if door.area_id:
+            key = door.area_id
+            door_class, depth, seed = world.store.origins[key][:3]
+            job = ((door_class, depth, seed), functools.partial(world.store.rebuild, world, key), area.id)
+        else:
+            key = door.seed
+            if key in self.warm:
+                _, level = self.warm.pop(key)
+                door.build_area(world, level, area, position)
+                enter_door(world, player, door)
+                return
+            job = ((type(door), door.depth, door.seed),
+                   functools.partial(door.build_area, world, exit_area=area, exit_position=position), area.id)
+
+        player.notice("you descend into {}...".format(door))
+        self.waiting[key].append((player, door, area))
+        player.descending = True
+        self.speculative.discard(key)
+        # a job started for the same door before its area was reloaded builds from this one
+        queued = key in self.doors
+        self.doors[key] = job
+        if not queued:
+            self.queued.append(key)
+            self.submit()
+
+    def submit(self):
+        while self.queued and len(self.jobs) < self.limit:
+            self._start(self.queued.popleft())
+
+    def _start(self, key):
+        args, _, _ = self.doors[key]
+        if self.executor:
+            future = self.executor.submit(generate_level, *args)
+        else:
+            future = concurrent.futures.Future()
+            future.set_result(generate_level(*args))
+        self.jobs[key] = future
+
+    def warm_up(self, world):
+        """
+        Starts generating the levels behind the unopened doors within warm_distance of
+        a player, nearest first, while no one is waiting for a slot
+        """
+        candidates = []
+        wanted = set()
+        for player in world.players:
+            area = world.get_area(player)
+            if not area:
+                continue
+            for (x, y), tile in area.terrain.special.items():
+                if not isinstance(tile, LevelDoor) or tile.area_id:
+                    continue
+                distance = max(abs(x - player.x), abs(y - player.y))
+                if distance > self.warm_distance:
+                    continue
+                key = tile.seed
+                if key in self.warm:
+                    self.warm.move_to_end(key)
+                    wanted.add(key)
+                elif key not in self.doors:
+                    candidates.append((distance, key, tile, area, (x, y)))
+
+        for _, key, door, area, position in sorted(candidates, key=lambda c: c[0]):
+            if self.queued or len(self.jobs) >= self.limit or len(self.speculative) >= self.warm_jobs:
+                break
+            # only levels nobody is near any more may make room for new ones
+            if len(wanted) + len(self.speculative) >= self.warm_levels:
+                break
+            if key in self.doors:
+                continue
+            self.doors[key] = ((type(door), door.depth, door.seed),
+                               functools.partial(door.build_area, world, exit_area=area, exit_position=position),
+                               area.id)
+            self.speculative.add(key)
+            self._start(key)
+
+    def poll(self, world):
+        for key, future in list(self.jobs.items()):
+            if not future.done():
+                continue
+            del self.jobs[key]
+            args, build, source = self.doors.pop(key)
+            waiting = self.waiting.pop(key, [])
+            self.speculative.discard(key)
+
+            try:
+                level = future.result()
+            except Exception:
+                log.exception("could not generate %s level at depth %d", args[0].NAME, args[1])
+                for player, _, _ in waiting:
+                    player.descending = False
+                    player.notice("the way down is blocked")
+                continue
 
-    SIZE = 200
+            if not waiting:
+                self.warm[key] = (source, level)
+                while len(self.warm) > self.warm_levels:
+                    self.warm.popitem(last=False)
+                continue
 
-    def __init__(self, *args, **kwargs):
-        self.depth = kwargs.pop("depth", 0)
-        kwargs["message"] = "cave level {}".format(self.depth)
-        super(CaveDoor, self).__init__(*args, **kwargs)
-
-    def generate_cave(self, exit_area, exit_position):
-        tiles = generate_cave(self.SIZE, self.SIZE, depth=self.depth + 1)
-
-        while True:
-            dx = random.randrange(0, len(tiles[0]))
-            dy = random.randrange(0, len(tiles))
-            tile = tiles[dy][dx]
-            if not tile.blocked:
-                if self.depth > 1:
-                    message = "a door to cave level {}".format(self.depth - 1)
-                else:
-                    message = "an exit to the world"
-                tiles[dy][dx] = Door("stairsup1", area=exit_area, position=exit_position, message=message)
-                break
+            build(level)
+            for player, door, area in waiting:
+                player.descending = False
+                if player.is_alive and world.get_area(player) is area:
+                    enter_door(world, player, door)
+
+        for key, (source, _) in list(self.warm.items()):
+            if source not in AreaRegistry:
+                del self.warm[key]
+
+        self.submit()
+        if self.executor and not world.age % WARM_INTERVAL:
+            self.warm_up(world)
+
+
+def generate_cave(width, height, iterations=5, depth=0, fill=CAVE_FILL, birth=CAVE_BIRTH, survival=CAVE_SURVIVAL,
+                  rng=random):
+    """
+    Cellular automaton caves. The interior starts with the fill ratio of floor drawn
+    at random and every step a floor cell turns to wall when its count of wall
+    neighbors is in birth, a wall stays one when it is in survival.
+    """
+    cells = numpy.random.default_rng(rng.getrandbits(64))
+
+    walls = numpy.ones((height, width), dtype=numpy.bool_)
+    interior = walls[1:-1, 1:-1]
+    num_floor = min(int(round(width * height * fill)), interior.size)
+    floor = cells.choice(interior.size, num_floor, replace=False)
+    interior.flat[floor] = False
+
+    birth = numpy.isin(numpy.arange(9), birth)
+    survival = numpy.isin(numpy.arange(9), survival)
+    padded = numpy.zeros((height + 2, width + 2), dtype=numpy.uint8)
+    for _ in range(iterations):
+        padded[1:-1, 1:-1] = walls
+        neighbors = sum(
+            padded[1 + dy:height + 1 + dy, 1 + dx:width + 1 + dx]
+            for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy
+        )
+        walls = numpy.where(walls, survival[neighbors], birth[neighbors])
 
-        return Area("Cave", tiles, self.depth), (dx, dy)
+    walls[[0, -1], :] = True
+    walls[:, [0, -1]] = True
 
-    def get_area(self, world, exit_area, exit_position):
-        if not self.area:
-            log.info("generating cave...")
-            self.area, self.position = self.generate_cave(exit_area, exit_position)
-            populate_area(world, self.area)
-            log.info("cave done!")
-        return super(CaveDoor, self).get_area(world, exit_area, exit_position)
+    tiles = TileGrid.from_palette([Tile("grey3"), Tile("wall3", blocked=True, blocked_sight=True)], walls.view(numpy.uint8))
+    add_doors(CaveDoor, tiles, NUM_DOORS, depth=depth, key="crypt1", rng=rng)
+    return tiles
 
 
-class DungeonDoor(Door):
+class CaveDoor(LevelDoor):
+    NAME = "Cave"
     SIZE = 200
-    MIN_SIZE = 10
 
-    def __init__(self, *args, **kwargs):
-        self.depth = kwargs.pop("depth", 0)
-        kwargs["message"] = "dungeon level {}".format(self.depth)
-        super(DungeonDoor, self).__init__(*args, **kwargs)
-
-    def generate_dungeon(self, exit_area, exit_position):
-        tiles = generate_dungeon(self.SIZE, self.SIZE, self.MIN_SIZE)
-        while True:
-            dx = random.randrange(0, len(tiles[0]))
-            dy = random.randrange(0, len(tiles))
-            tile = tiles[dy][dx]
-            if not tile.blocked:
-                if self.depth > 1:
-                    message = "a door to dungeon level {}".format(self.depth - 1)
-                else:
-                    message = "an exit to the world"
-                tiles[dy][dx] = Door("stairsup1", area=exit_area, position=exit_position, message=message)
-                break
-        return Area("Dungeon", tiles, self.depth), (dx, dy)
+    @classmethod
+    def generate_tiles(cls, depth, rng):
+        return generate_cave(cls.SIZE, cls.SIZE, depth=depth + 1, rng=rng)
 
-    def get_area(self, world, exit_area, exit_position):
-        if not self.area:
-            log.info("generating dungeon...")
-            self.area, self.position = self.generate_dungeon(exit_area, exit_position)
-            populate_area(world, self.area)
-            log.info("dungeon done!")
 
-        return super(DungeonDoor, self).get_area(world, exit_area, exit_position)
+class DungeonDoor(LevelDoor):
+    NAME = "Dungeon"
+    SIZE = 200
+    MIN_SIZE = 10
+
+    @classmethod
+    def generate_tiles(cls, depth, rng):
+        return generate_dungeon(cls.SIZE, cls.SIZE, cls.MIN_SIZE, rng=rng)
 
 
 class Room(collections.namedtuple("Room", ["x", "y", "w", "h"])):
@@ -222,18 +489,18 @@ class Room(collections.namedtuple("Room", ["x", "y", "w", "h"])):
         )
 
 
-def partition(room, min_size):
+def partition(room, min_size, rng=random):
     rooms = []
     tunnels = []
 
     def _too_small(p):
         return p.w <= min_size or p.h <= min_size
 
-    remaining = [room]
+    remaining = collections.deque([room])
     while remaining:
-        part = remaining.pop(0)
-        orientation = bool(random.randint(0, 1))
-        a, b = split_room(part, orientation)
+        part = remaining.popleft()
+        orientation = bool(rng.randint(0, 1))
+        a, b = split_room(part, orientation, rng)
         tunnels.append((a, b))
         if _too_small(a) or _too_small(b):
             rooms.append(part)
@@ -243,67 +510,62 @@ def partition(room, min_size):
     return rooms, tunnels
 
 
-def split_room(room, vertical):
+def split_room(room, vertical, rng=random):
     if vertical:
-        s = random.randint(room.h // 2, 3 * room.h // 4)
+        s = rng.randint(room.h // 2, 3 * room.h // 4)
         a, b = Room(room.x, room.y, room.w, s), Room(room.x, room.y + s, room.w, room.h - s)
     else:
-        s = random.randint(room.w // 2, 3 * room.w // 4)
+        s = rng.randint(room.w // 2, 3 * room.w // 4)
         a, b = Room(room.x, room.y, s, room.h), Room(room.x + s, room.y, room.w - s, room.h)
     return a, b
 
 
-def generate_dungeon(width, height, min_size, depth=0):
+def generate_dungeon(width, height, min_size, depth=0, rng=random):
     outer = Room(0, 0, width, height)
-    parts, tunnels = partition(outer, min_size)
+    parts, tunnels = partition(outer, min_size, rng)
 
     def _generate_room(r):
-        offset_x = random.randint(0, r.w//4)
-        offset_y = random.randint(0, r.h//4)
+        offset_x = rng.randint(0, r.w//4)
+        offset_y = rng.randint(0, r.h//4)
 
-        w = random.randint(r.w//4, 3 * r.w//3)
+        w = rng.randint(r.w//4, 3 * r.w//3)
         if offset_x + w >= r.w:
             w = r.w - 4
 
-        h = random.randint(r.h//4, 3 * r.h//4)
+        h = rng.randint(r.h//4, 3 * r.h//4)
         if offset_y + h >= r.h:
             h = r.h - 4
 
         return Room(r.x + offset_x, r.y + offset_y, w, h)
 
     rooms = [_generate_room(room) for room in parts]
-    tiles = render_dungeon(width, height, rooms, tunnels)
-    add_doors(DungeonDoor, tiles, NUM_DOORS, depth=depth, key="crypt2")
+    floor = render_dungeon(width, height, rooms, tunnels)
+    tiles = TileGrid.from_palette([Tile("wall3", blocked=True, blocked_sight=True), Tile("grey3")], floor.view(numpy.uint8))
+    add_doors(DungeonDoor, tiles, NUM_DOORS, depth=depth, key="crypt2", rng=rng)
     return tiles
 
 
 # http://www.roguebasin.com/index.php?title=Basic_BSP_Dungeon_generation
 def render_dungeon(width, height, rooms, tunnels):
-
-    def _inside(x, y):
-        return any(room.contains(x, y) for room in rooms) and x < width - 1 and y < height - 1
-
-    rows = [[_inside(x, y) for x in range(width)] for y in range(height)]
+    """
+    Rasterizes rooms, their edges included, and the tunnels between partitions into a
+    (height, width) array that is True on floor. The last row and column stay wall.
+    """
+    floor = numpy.zeros((height, width), dtype=numpy.bool_)
+    inner = floor[:height - 1, :width - 1]
+    for room in rooms:
+        if room.w >= 0 and room.h >= 0:
+            inner[room.y:room.b + 1, room.x:room.l + 1] = True
 
     for tunnel in tunnels:
         a, b = sorted(tunnel)
 
         a_cx, a_cy = a.center
         b_cx, b_cy = b.center
-        for x in range(a_cx, b_cx):
-            if x >= width - 1:
-                continue
-            rows[a_cy][x] = True
-
-        for y in range(a_cy, b_cy):
-            if y >= height - 1:
-                continue
-            rows[y][a_cx] = True
-
-    def _tile(cell):
-        return Tile("grey3") if cell else Tile("wall3", blocked=True, blocked_sight=True)
+        floor[a_cy, a_cx:min(b_cx, width - 1)] = True
+        floor[a_cy:min(b_cy, height - 1), a_cx] = True
 
-    return [[_tile(cell) for cell in row] for row in rows]
+    return floor
 
 
 class Cardinal(Enum):
@@ -313,19 +575,18 @@ class Cardinal(Enum):
     WEST = -1, 0
 
 
-def generate_maze(width, height):
+def generate_maze(width, height, rng=random):
 
-    grid = [[False for _ in range(width)] for __ in range(height)]
-    x, y = random.randint(0, width - 1), random.randint(0, height - 1)
+    grid = [[False] * width for _ in range(height)]
+    x, y = rng.randint(0, width - 1), rng.randint(0, height - 1)
     grid[y][x] = True
 
-    wall_list = [(x, y, w) for w in Cardinal]
+    directions = [w.value for w in Cardinal]
+    wall_list = [(x, y, d) for d in directions]
     while wall_list:
-        item = random.choice(wall_list)
-        wall_list.remove(item)
-        x, y, w = item
+        # the same draw as rng.choice, walls are unique so this is the one remove took
+        x, y, (dx, dy) = wall_list.pop(rng.randrange(len(wall_list)))
 
-        dx, dy = w.value
         nx, ny = x + (2 * dx), y + (2 * dy)
         if nx < 0 or nx >= width or ny < 0 or ny >= height:
             continue
@@ -334,8 +595,7 @@ def generate_maze(width, height):
             continue
 
         count = 0
-        for passage in Cardinal:
-            cx, cy = passage.value
+        for cx, cy in directions:
             px, py = nx + (2 * cx), ny + (2 * cy)
             if px < 0 or px >= width or py < 0 or py >= height:
                 continue
@@ -350,107 +610,68 @@ def generate_maze(width, height):
         px, py = x + dx, y + dy
         grid[py][px] = True
 
-        wall_list.extend([(nx, ny, w) for w in Cardinal])
+        wall_list.extend([(nx, ny, d) for d in directions])
 
-    def _tile(cell):
-        return Tile("wall3", blocked=True, blocked_sight=True) if not cell else Tile("grey3")
-    return [[_tile(cell) for cell in row] for row in grid]
+    floor = numpy.array(grid, dtype=numpy.uint8)
+    return TileGrid.from_palette([Tile("wall3", blocked=True, blocked_sight=True), Tile("grey3")], floor)
 
 
-class MazeDoor(Door):
+class MazeDoor(LevelDoor):
+    NAME = "Maze"
     WIDTH = HEIGHT = 200
 
-    def __init__(self, *args, **kwargs):
-        self.depth = kwargs.pop("depth", 0)
-        kwargs["message"] = "maze level {}".format(self.depth)
-        super(MazeDoor, self).__init__(*args, **kwargs)
-
-    def generate_maze(self, exit_area, exit_position):
-        tiles = generate_maze(self.WIDTH, self.HEIGHT)
-        while True:
-            dx = random.randrange(0, len(tiles[0]))
-            dy = random.randrange(0, len(tiles))
-            tile = tiles[dy][dx]
-            if not tile.blocked:
-                if self.depth > 1:
-                    message = "a door to maze level {}".format(self.depth - 1)
-                else:
-                    message = "an exit to the world"
-                tiles[dy][dx] = Door("stairsup1", area=exit_area, position=exit_position, message=message)
-                break
-        return Area("Maze", tiles, self.depth), (dx, dy)
+    @classmethod
+    def generate_tiles(cls, depth, rng):
+        return generate_maze(cls.WIDTH, cls.HEIGHT, rng)
 
-    def get_area(self, world, exit_area, exit_position):
-        if not self.area:
-            log.info("generating maze...")
-            self.area, self.position = self.generate_maze(exit_area, exit_position)
-            populate_area(world, self.area)
-            log.info("maze done!")
-        return super(MazeDoor, self).get_area(world, exit_area, exit_position)
 
-
-def generate_map(size, iterations=500, max_radius=50):
-    heightmap = [[0. for _ in range(size)] for __ in range(size)]
+def generate_heightmap(size, iterations=500, max_radius=50, rng=random):
+    """
+    Sums random round hills, each only over the square it covers, and normalizes the
+    result to [0, 1]. Draws the same random numbers as the cell by cell version did so
+    a seed still yields the same map.
+    """
+    heightmap = numpy.zeros((size, size))
 
     for _ in range(iterations):
 
-        cx = random.randrange(0, size)
-        cy = random.randrange(0, size)
-        radius = random.randint(1, max_radius)
-        radius_squared = radius ** 2
-
-        for y in range(size):
-            for x in range(size):
-                height = radius_squared - (((x - cx)**2) + ((y - cy)**2))
-                if height > 0:
-                    heightmap[y][x] += height
-
-    min_height = min(height for row in heightmap for height in row)
-    max_height = max(height for row in heightmap for height in row)
-    delta = max_height - min_height
-
-    for y in range(size):
-        for x in range(size):
-            heightmap[y][x] = (heightmap[y][x] - min_height) / delta
-
-    def _tile(x, y, height):
-        if x == 0 or y == 0 or x == size - 1 or y == size - 1:
-            return Tile("water1", blocked=True, blocked_sight=False)
-
-        if height < .1:
-            return Tile("water3", blocked=True)
-        elif height < .2:
-            return Tile("water2", blocked=True)
-        elif height < .3:
-            return Tile("water1", blocked=True)
-        elif height < .4:
-            return Tile("sand1")
-        elif height < .45:
-            return Tile("sand2")
-        elif height < .5:
-            return Tile("sand3")
-        elif height < .6:
-            return Tile("grass1")
-        elif height < .8:
-            return Tile("grass2")
-        elif height < .95:
-            return Tile("grass3")
-        else:
-            return Tile("mountains1", blocked=True)
+        cx = rng.randrange(0, size)
+        cy = rng.randrange(0, size)
+        radius = rng.randint(1, max_radius)
+
+        left, right = max(cx - radius + 1, 0), min(cx + radius, size)
+        top, bottom = max(cy - radius + 1, 0), min(cy + radius, size)
+        dx = numpy.arange(left, right) - cx
+        dy = numpy.arange(top, bottom)[:, None] - cy
+        height = radius ** 2 - (dx ** 2 + dy ** 2)
+        heightmap[top:bottom, left:right] += numpy.maximum(height, 0)
+
+    min_height = heightmap.min()
+    delta = heightmap.max() - min_height
+    return (heightmap - min_height) / delta
+
+
+def generate_map(size, iterations=500, max_radius=50, rng=random):
+    heightmap = generate_heightmap(size, iterations, max_radius, rng)
+
+    bands = numpy.digitize(heightmap, [bound for bound, _ in TERRAIN_BANDS[:-1]])
+    bands[[0, -1], :] = BORDER_BAND
+    bands[:, [0, -1]] = BORDER_BAND
 
-    tiles = [[_tile(x, y, height) for x, height in enumerate(row)] for y, row in enumerate(heightmap)]
-    add_doors(CaveDoor, tiles, depth=1, key="crypt1")
-    add_doors(DungeonDoor, tiles, depth=1, key="crypt2")
-    add_doors(MazeDoor, tiles, depth=1, key="crypt3")
+    tiles = TileGrid.from_palette([tile for _, tile in TERRAIN_BANDS], bands)
+    add_doors(CaveDoor, tiles, depth=1, key="crypt1", rng=rng)
+    add_doors(DungeonDoor, tiles, depth=1, key="crypt2", rng=rng)
+    add_doors(MazeDoor, tiles, depth=1, key="crypt3", rng=rng)
     return tiles
 
 
-def generate_world(size):
+def generate_world(size, rng=random):
     log.info("generating world...")
 
-    area = Area("The world", generate_map(size, iterations=500), 0)
+    area = Area("The world", generate_map(size, iterations=500, rng=rng), 0)
     world = World(area)
-    populate_area(world, area)
+    world.levels = LevelGenerator()
+    populate_area(world, area, rng=rng)
 
     log.info("world done!")
 
@@ -10,11 +10,13 @@ from fastapi.responses import Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 import msgpack
+import numpy
 from PIL import Image
 
 from .world import DAY, AreaRegistry
+from .messages import pack
 from .actions import MoveAction, UseItemAction, PickupItemAction, EquipAction, MeleeAttackAction, EnterAction
-from .actor import Player, Actor
+from .actor import Player
 from .util import project_enum
 from .tiles import ASSET_PATH, MUSIC, AssetTypes
 
@@ -23,6 +25,13 @@ log = logging.getLogger(__name__)
 app = FastAPI()
 
 QUEUE_SIZE = 100
+FRAME_HISTORY = 32
+
+# the writer bundles queued messages into one msgpack array per send for clients
+# supporting it, up to about BATCH_SIZE bytes, waiting at most BATCH_LATENCY seconds
+# for more messages once it has one
+BATCH_SIZE = 64 * 1024
+BATCH_LATENCY = 0
 HEARTBEAT = 5
 RECV_TIMEOUT = 10
 UPDATE_TIMEOUT = .1
@@ -130,31 +139,118 @@ def handle_waypoint(world, player, action):
     player.set_waypoint(waypoint)
 
 
+class Outbox(object):
+    """
+    Outbound messages of a player in two lanes: a bounded reliable lane for notices,
+    stats, chunks and responses, and a single frame slot that newer frames overwrite.
+    The writer empties the reliable lane first, so a slow client only ever has the
+    latest frame waiting and frames never refer to chunks it was not sent yet.
+    """
+
+    def __init__(self, size=QUEUE_SIZE):
+        self.size = size
+        self.reliable = collections.deque()
+        self.frame = None
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    def qsize(self):
+        return len(self.reliable) + (self.frame is not None)
+
+    def empty(self):
+        return not self.reliable and self.frame is None and not self.closed
+
+    def put_nowait(self, msg):
+        if len(self.reliable) >= self.size:
+            raise asyncio.QueueFull()
+        self.reliable.append(msg)
+        self.ready.set()
+
+    def put_frame(self, msg):
+        self.frame = msg
+        self.ready.set()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    def clear(self):
+        self.reliable.clear()
+        self.frame = None
+
+    def get_nowait(self):
+        """
+        The next message by priority, then None once if the outbox was closed
+        """
+        if self.reliable:
+            return self.reliable.popleft()
+        if self.closed:
+            self.closed = False
+            return None
+        if self.frame is not None:
+            msg, self.frame = self.frame, None
+            return msg
+        raise asyncio.QueueEmpty()
+
+    async def get(self):
+        while self.empty():
+            self.ready.clear()
+            await self.ready.wait()
+        return self.get_nowait()
+
+
 @dataclasses.dataclass
 class WebSocketPlayer(Player):
 
     def __init__(self, key, tileset, world, *args, **kwargs):
         super(Player, self).__init__(key, *args, **kwargs)
         self.tilemap = tileset
-        self.response_queue = asyncio.Queue(QUEUE_SIZE)
+        self.response_queue = Outbox()
         self.world = world
+        self.needs_frame = False
+
+        # features negotiated in the hello message
+        self.features = set()
+
+        # frames sent but not yet superseded by an acknowledged one, for delta encoding
+        self.frame_seq = 0
+        self.sent_frames = collections.OrderedDict()
+        self.acked_frame = None
+
+        # chunk hashes the client holds and the one it was told for each (area, chunk)
+        self.known_chunks = set()
+        self.sent_chunks = {}
 
     def send_message(self, **msg):
+        if not msg:
+            self.response_queue.close()
+            return
+        self.receive(msg)
+
+    def receive(self, msg):
         try:
-            self.response_queue.put_nowait(msg or None)
-        except asyncio.queues.QueueFull:
+            self.response_queue.put_nowait(msg)
+        except asyncio.QueueFull:
             log.warning("queue full %s", self)
-            while not self.response_queue.empty():
-                self.response_queue.get_nowait()
-            self.response_queue.put_nowait(None)
+            self.response_queue.clear()
+            self.response_queue.close()
             self.world.remove_actor(self)
 
+    def send_frame(self, **msg):
+        msg["_event"] = "frame"
+        self.response_queue.put_frame(msg)
+
     def send_event(self, event_name, **msg):
         msg["_event"] = event_name
         self.send_message(**msg)
 
     def notify(self):
-        self.queue_frame(self.world)
+        self.needs_frame = True
+
+    def flush(self):
+        if self.needs_frame:
+            self.needs_frame = False
+            self.queue_frame(self.world)
 
     def healed(self, actor, damage):
         self.notice("you feal better, +{} health".format(damage))
@@ -194,29 +290,97 @@ class WebSocketPlayer(Player):
             rv.append(row)
         return rv
 
+    def ack_frame(self, seq):
+        if seq not in self.sent_frames:
+            return
+        self.acked_frame = seq
+        while next(iter(self.sent_frames)) != seq:
+            self.sent_frames.popitem(last=False)
+
     def queue_frame(self, world):
         area = world.get_area(self)
         if not area:
             return
-        frame = self.get_frame(area)
-        self.send_event("frame",
-                        id=area.id,
-                        frame=frame,
-                        x=self.x,
-                        y=self.y,
-                        width=area.map_width,
-                        height=area.map_height)
+        self.frame_seq += 1
+        msg = {
+            "id": area.id,
+            "seq": self.frame_seq,
+            "x": self.x,
+            "y": self.y,
+            "width": area.map_width,
+            "height": area.map_height,
+        }
+
+        if "chunks" in self.features:
+            self.send_chunks(area)
+
+        packed = "packed" in self.features
+        if "delta" in self.features:
+            frame = self.get_packed_planes(area) if packed else self.get_frame(area)
+            base = self.sent_frames.get(self.acked_frame)
+            if base and base[0] == area.id:
+                _, base_x, base_y, base_frame = base
+                msg["base"] = self.acked_frame
+                if packed:
+                    msg["packed_delta"] = packed_delta(base_x, base_y, base_frame, self.x, self.y, frame)
+                else:
+                    msg["delta"] = frame_delta(base_x, base_y, base_frame, self.x, self.y, frame)
+            else:
+                # nothing older than a keyframe may be used as a base again
+                if packed:
+                    msg["packed"] = self.get_packed_frame(area, frame)
+                else:
+                    msg["frame"] = frame
+                self.sent_frames.clear()
+                self.acked_frame = None
+
+            self.sent_frames[self.frame_seq] = (area.id, self.x, self.y, frame)
+            while len(self.sent_frames) > FRAME_HISTORY:
+                self.sent_frames.popitem(last=False)
+        elif packed:
+            msg["packed"] = self.get_packed_frame(area)
+        else:
+            msg["frame"] = self.get_frame(area)
+
+        self.send_frame(**msg)
+
+    def send_chunks(self, area):
+        """
+        Sends the terrain chunks under the view the client was not told about yet or
+        that changed since, leaving out the tiles of those it already holds
+        """
+        width = height = 2 * self.attributes.view_distance
+        left = self.x - int(width / 2)
+        top = self.y - int(height / 2)
+
+        chunks = area.terrain_chunks(self.tilemap)
+        for cx, cy in chunks.covering(left, top, width, height):
+            chunk = chunks.get(cx, cy)
+            if self.sent_chunks.get((area.id, cx, cy)) == chunk.hash:
+                continue
+            self.sent_chunks[(area.id, cx, cy)] = chunk.hash
+
+            msg = {
+                "id": area.id,
+                "x": chunk.x,
+                "y": chunk.y,
+                "width": chunk.width,
+                "height": chunk.height,
+                "hash": chunk.hash,
+            }
+            if chunk.hash not in self.known_chunks:
+                self.known_chunks.add(chunk.hash)
+                msg["tiles"] = chunk.tiles
+            self.send_event("chunk", **msg)
 
     def get_frame(self, area):
         width = height = 2 * self.attributes.view_distance
         tiles = self.visible_tiles(area, width, height)
+        with_tiles = "chunks" not in self.features
 
-        object_map = collections.defaultdict(list)
-        for obj in area.objects:
-            object_map[(obj.x, obj.y)].append(obj)
-
-        def keyfn(o):
-            return isinstance(o, Actor)
+        left = self.x - int(width / 2)
+        top = self.y - int(height / 2)
+        object_map = dict(area.objects_within(left, top, left + width, top + height))
 
         fov = area.fov(self)
         rv = []
@@ -224,17 +388,142 @@ class WebSocketPlayer(Player):
             rv_row = []
             for cell in row:
                 pos, tile = cell
-                in_fov = pos in fov
-                tile_index = self.tilemap.get_index(tile.key) if in_fov else -1
+                in_fov = fov.is_visible(*pos)
+                tile_index = self.tilemap.get_index(tile.key) if in_fov and with_tiles else -1
 
                 objs = object_map.get(pos)
-                objs = sorted(objs, key=keyfn, reverse=True) if objs else None
                 obj_indexes = [self.tilemap.get_index(obj.key) for obj in objs] if objs else [-1]
                 rv_row.append([in_fov, tile_index] + obj_indexes)
             rv.append(rv_row)
         rv[int(height / 2)][int(width / 2)][-1] = self.tilemap.get_index(self.key)
         return rv
 
+    def get_packed_planes(self, area):
+        """
+        The fov and tile index planes of the frame, the tiles None for clients streaming
+        terrain chunks, and the object indexes of each occupied cell by its row major
+        index
+        """
+        width = height = 2 * self.attributes.view_distance
+        left = self.x - int(width / 2)
+        top = self.y - int(height / 2)
+
+        fov = area.fov(self)
+        mask = numpy.frombuffer(fov.mask, dtype=numpy.uint8).reshape(fov.size, fov.size)
+        visible = mask[top - fov.top:top - fov.top + height, left - fov.left:left - fov.left + width].copy()
+
+        terrain = area.terrain
+        l, t = max(left, 0), max(top, 0)
+        r, b = min(left + width, terrain.width), min(top + height, terrain.height)
+
+        tiles = None
+        if "chunks" not in self.features:
+            tiles = numpy.full((height, width), -1, dtype="<i2")
+            if l < r and t < b:
+                indexes = numpy.array([self.tilemap.get_index(key) for key in terrain.keys], dtype="<i2")
+                tiles[t - top:b - top, l - left:r - left] = indexes[terrain.key_ids[t:b, l:r]]
+            tiles[visible == 0] = -1
+
+        objects = {}
+        for (x, y), objs in area.objects_within(left, top, left + width, top + height):
+            obj_indexes = [self.tilemap.get_index(obj.key) for obj in objs]
+            if (x, y) == self.pos:
+                obj_indexes[-1] = self.tilemap.get_index(self.key)
+            objects[(y - top) * width + (x - left)] = obj_indexes
+        return visible, tiles, objects
+
+    def get_packed_frame(self, area, planes=None):
+        """
+        The frame as little endian planes: a byte per cell for fov, an int16 tile index
+        per cell and an int16 list of (cell index, object count, *object indexes) for
+        the occupied cells, each row major. The tile plane is left out for clients
+        streaming terrain chunks.
+        """
+        visible, tiles, objects = planes or self.get_packed_planes(area)
+        height, width = visible.shape
+        rv = {
+            "width": width,
+            "height": height,
+            "fov": visible.tobytes(),
+        }
+        if tiles is not None:
+            rv["tiles"] = tiles.tobytes()
+
+        cells = []
+        for index, obj_indexes in objects.items():
+            cells.extend([index, len(obj_indexes)] + obj_indexes)
+        rv["objects"] = numpy.array(cells, dtype="<i2").tobytes()
+        return rv
+
+
+def frame_delta(base_x, base_y, base_frame, x, y, frame):
+    """
+    Lists the cells of frame that differ from the cell at the same map position in the
+    base frame, as [index, *cell] where index is row major within the frame
+    """
+    offset_x = x - base_x
+    offset_y = y - base_y
+    width = len(frame[0])
+
+    rv = []
+    for j, row in enumerate(frame):
+        base_j = j + offset_y
+        base_row = base_frame[base_j] if 0 <= base_j < len(base_frame) else None
+        for i, cell in enumerate(row):
+            base_i = i + offset_x
+            if base_row is not None and 0 <= base_i < len(base_row) and base_row[base_i] == cell:
+                continue
+            rv.append([j * width + i] + cell)
+    return rv
+
+
+def packed_delta(base_x, base_y, base_planes, x, y, planes):
+    """
+    The cells of packed frame planes that differ from the cell at the same map position
+    in the base planes, as a little endian int16 list of (cell index, object count, fov,
+    tile index, *object indexes), row major
+    """
+    visible, tiles, objects = planes
+    base_visible, base_tiles, base_objects = base_planes
+    height, width = visible.shape
+    offset_x = x - base_x
+    offset_y = y - base_y
+
+    # cells the base does not cover always differ
+    changed = numpy.ones((height, width), dtype=numpy.bool_)
+    l, r = max(0, -offset_x), min(width, width - offset_x)
+    t, b = max(0, -offset_y), min(height, height - offset_y)
+    if l < r and t < b:
+        base_window = (slice(t + offset_y, b + offset_y), slice(l + offset_x, r + offset_x))
+        same = visible[t:b, l:r] == base_visible[base_window]
+        if tiles is not None:
+            same &= tiles[t:b, l:r] == base_tiles[base_window]
+        changed[t:b, l:r] = ~same
+
+    def _base_index(index):
+        j, i = divmod(index, width)
+        bj, bi = j + offset_y, i + offset_x
+        return bj * width + bi if 0 <= bj < height and 0 <= bi < width else None
+
+    flat = changed.reshape(-1)
+    for index, obj_indexes in objects.items():
+        if base_objects.get(_base_index(index)) != obj_indexes:
+            flat[index] = True
+    for base_index in base_objects:
+        j, i = divmod(base_index, width)
+        nj, ni = j - offset_y, i - offset_x
+        if 0 <= nj < height and 0 <= ni < width and nj * width + ni not in objects:
+            flat[nj * width + ni] = True
+
+    fov = visible.reshape(-1)
+    tile_indexes = tiles.reshape(-1) if tiles is not None else None
+    cells = []
+    for index in numpy.flatnonzero(flat).tolist():
+        obj_indexes = objects.get(index, [])
+        tile = int(tile_indexes[index]) if tile_indexes is not None else -1
+        cells.extend([index, len(obj_indexes), int(fov[index]), tile] + obj_indexes)
+    return numpy.array(cells, dtype="<i2").tobytes()
+
 
 @app.get("/")
 async def get_root(request: Request):
@@ -258,6 +547,9 @@ async def get_root(request: Request):
 def _handle_message(world, player, message):
     if "ping" in message:
         response = {"pong": message["ping"]}
+    elif "ack" in message:
+        player.ack_frame(message["ack"])
+        response = None
     elif "action" in message:
         response = dispatcher.dispatch(world, player, message)
     else:
@@ -275,6 +567,40 @@ def _generate_player(player_name, tileset, world):
     return player
 
 
+async def next_batch(queue, first, max_size=BATCH_SIZE, latency=BATCH_LATENCY):
+    """
+    Packs first and whatever follows it in the queue into a single msgpack array,
+    stopping at max_size bytes, at the end of the queue once latency has passed or at
+    the None closing it. Shared messages go in with the bytes they were encoded to
+    once. Returns the packed batch and whether the queue was closed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + latency
+
+    items = [pack(first)]
+    size = len(items[0])
+    done = False
+    while size < max_size:
+        if not queue.empty():
+            response = queue.get_nowait()
+        else:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                response = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        if response is None:
+            done = True
+            break
+        items.append(pack(response))
+        size += len(items[-1])
+
+    packer = msgpack.Packer()
+    return packer.pack_array_header(len(items)) + b"".join(items), done
+
+
 @app.websocket("/session")
 async def session(websocket: WebSocket):
 
@@ -297,6 +623,8 @@ async def session(websocket: WebSocket):
     player_name = obj["profile"]["name"]
 
     player = _generate_player(player_name, app.state.tileset, app.state.world)
+    player.features = set(obj.get("features", []))
+    player.known_chunks = set(obj.get("chunks", []))
     app.state.world.place_actor(player)
 
     player.send_stats()
@@ -305,16 +633,22 @@ async def session(websocket: WebSocket):
 
     async def _writer():
 
+        batched = "batch" in player.features
         while player.is_alive:
             response = await player.response_queue.get()
             if response is None:
                 break
-            msg = msgpack.packb(response)
+            if batched:
+                msg, done = await next_batch(player.response_queue, response)
+            else:
+                msg, done = pack(response), False
             try:
                 await websocket.send_bytes(msg)
             except WebSocketDisconnect:
                 log.error("writer closed")
                 break
+            if done:
+                break
         # await websocket.close()
         log.info("writer stopped")
 
@@ -372,6 +706,12 @@ async def admin():
     return _render("admin.html", world=app.state.world)
 
 
+@app.get(r"/admin/store")
+async def store_metrics():
+    store = app.state.world.store
+    return store.metrics if store else {}
+
+
 def _render_map(area, tileset, scale=.25):
 
     tilesize = tileset.tilesize
@@ -0,0 +1,194 @@
+import os
+import time
+import pickle
+import logging
+import itertools
+import collections
+import threading
+
+from .actor import Actor, Player
+from .world import World, AreaRegistry, TIMEOUT
+from .storage import area_state, unpack_area, place_objects, pack, unpack
+from .procgen import LevelGenerator
+
+# the world is saved every SNAPSHOT_INTERVAL ticks, captured CAPTURE_AREAS areas a tick
+SNAPSHOT_INTERVAL = int(60 / TIMEOUT)
+CAPTURE_AREAS = 1
+
+MAGIC = b"RGWRLD"
+VERSION = 2
+
+log = logging.getLogger(__name__)
+
+
+def resident_areas(world):
+    areas = list(world.areas)
+    areas.extend(area for area in AreaRegistry.values() if area not in areas)
+    return areas
+
+
+def capture_area(area):
+    """
+    The pickled record of an area but its players. The area is left as it was, objects
+    only brought up to date, and the actors targeting players only forget them while
+    they are pickled.
+    """
+    objects = []
+    targets = []
+    for obj in area.objects:
+        if isinstance(obj, Player):
+            continue
+        area.sync_age(obj)
+        if isinstance(obj, Actor):
+            area.sync_energy(obj)
+            if isinstance(obj.target, Player):
+                targets.append((obj, obj.target))
+        objects.append((obj, area.spawns.get(id(obj))))
+
+    try:
+        for actor, _ in targets:
+            actor.target = None
+        return pickle.dumps(area_state(area, objects), protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for actor, target in targets:
+            actor.target = target
+
+
+def write(path, age, schedules, areas, stored, store):
+    """
+    Writes captured areas, with the files of the areas unloaded to the store, and
+    returns the size written
+    """
+    record = {
+        "age": age,
+        "schedules": schedules,
+        "areas": areas,
+        "stored": {area_id: (store.read(area_id), origin) for area_id, origin in stored},
+    }
+    data = pack(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL), MAGIC, VERSION)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    return len(data)
+
+
+def restore(path, store=None) -> World:
+    with open(path, "rb") as f:
+        record = pickle.loads(unpack(f, MAGIC, VERSION))
+
+    area_records = [pickle.loads(data) for data in record["areas"]]
+    areas = [unpack_area(area_record) for area_record in area_records]
+    world = World(areas[0])
+    world.areas = areas
+    for area, area_record in zip(areas, area_records):
+        place_objects(world, area, area_record)
+
+    world.age = record["age"]
+    world.schedules = record["schedules"]
+    world.counter = itertools.count(max((entry[1] for entry in world.schedules), default=-1) + 1)
+    world.levels = LevelGenerator()
+    if store:
+        for area_id, (data, origin) in record["stored"].items():
+            store.put(area_id, data, origin)
+        world.store = store
+    return world
+
+
+class Snapshots(object):
+    """
+    Saves the world every interval ticks without holding up the game loop for long.
+    The areas are pickled on the loop a few a tick, those replaced or journaled since
+    captured again at the end, then a thread reads the files of the stored areas and
+    compresses and writes it all while the game goes on. One snapshot is taken at a
+    time and the file is only replaced once it is complete.
+    """
+
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL, areas_per_tick=CAPTURE_AREAS):
+        self.path = path
+        self.interval = interval
+        self.areas_per_tick = areas_per_tick
+        self.thread = None
+        # ids of the areas left to capture while a snapshot is being taken
+        self.pending = None
+        # area id -> (area, journal length, pickled record)
+        self.captured = {}
+        self.started = 0.
+        self.capture_seconds = 0.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def poll(self, world):
+        if self.thread and not self.thread.is_alive():
+            self._written(world)
+        if self.pending is not None:
+            self._capture_some()
+            if not self.pending:
+                self._finish(world)
+        elif world.age and not world.age % self.interval:
+            if self.thread:
+                log.warning("skipped a snapshot, the last one is still being written")
+                return
+            self._begin(world)
+
+    def close(self, world):
+        """
+        Waits for the snapshot being written, then takes a last one at once
+        """
+        if self.thread:
+            self.thread.join()
+            self._written(world)
+        if self.pending is None:
+            self._begin(world)
+        self._finish(world)
+        self.thread.join()
+        self._written(world)
+
+    def _begin(self, world):
+        self.started = time.perf_counter()
+        self.capture_seconds = 0.
+        self.pending = collections.deque(area.id for area in resident_areas(world))
+        self.captured = {}
+
+    def _capture_some(self):
+        captured = 0
+        while self.pending and captured < self.areas_per_tick:
+            area = AreaRegistry.get(self.pending.popleft())
+            if area:
+                self._capture(area)
+                captured += 1
+
+    def _capture(self, area):
+        start = time.perf_counter()
+        self.captured[area.id] = (area, len(area.journal), capture_area(area))
+        self.capture_seconds += time.perf_counter() - start
+
+    def _finish(self, world):
+        areas = resident_areas(world)
+        for area in areas:
+            captured = self.captured.get(area.id)
+            if not captured or captured[0] is not area or captured[1] != len(area.journal):
+                self._capture(area)
+        store = world.store
+        stored = [(area_id, store.origins.get(area_id)) for area_id in store.stored] if store else []
+        if store:
+            store.pin(area_id for area_id, _ in stored)
+
+        args = (self.path, world.age, list(world.schedules), [self.captured[area.id][2] for area in areas],
+                stored, store)
+        self.pending = None
+        self.captured = {}
+        log.info("captured the world in %.3fs on the loop", self.capture_seconds)
+        self.thread = threading.Thread(target=self._write, args=args, name="snapshot")
+        self.thread.start()
+
+    def _write(self, *args):
+        try:
+            size = write(*args)
+        except Exception:
+            log.exception("could not save the world to %s", self.path)
+            return
+        log.info("saved the world, %d bytes in %.3fs", size, time.perf_counter() - self.started)
+
+    def _written(self, world):
+        self.thread = None
+        if world.store:
+            world.store.unpin()
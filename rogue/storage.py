@@ -0,0 +1,288 @@
+import os
+import time
+import zlib
+import pickle
+import struct
+import logging
+import tempfile
+import collections
+
+from .actor import Actor, Player
+from .world import Area, AreaRegistry, TIMEOUT
+from .procgen import generate_level
+
+# areas without players for IDLE_TICKS are unloaded to disk, checked every STORE_INTERVAL
+# ticks, and idle areas go sooner, least recently visited first, while the resident ones
+# are estimated to take more than RESIDENT_BUDGET bytes
+IDLE_TICKS = int(5 * 60 / TIMEOUT)
+STORE_INTERVAL = 50
+RESIDENT_BUDGET = 256 * 2 ** 20
+STORE_PATH = os.path.join(tempfile.gettempdir(), "rogue-areas")
+COMPRESSION = 1
+
+HEADER = struct.Struct("<6sHI")
+MAGIC = b"RGAREA"
+VERSION = 1
+
+# rough memory cost of a terrain cell, a special tile and an object
+CELL_BYTES = 4
+SPECIAL_BYTES = 512
+OBJECT_BYTES = 2048
+
+log = logging.getLogger(__name__)
+
+
+def footprint(area):
+    """
+    Estimate of the memory an area takes, from its size and object count
+    """
+    cells = area.map_width * area.map_height
+    objects = len(area.actor_registry) + len(area.inert_registry)
+    return cells * CELL_BYTES + len(area.terrain.special) * SPECIAL_BYTES + objects * OBJECT_BYTES
+
+
+def area_record(world, area):
+    """
+    The area's terrain, with its tile arrays, and a record of each object other than
+    players with its spawn index. Takes the objects out of the area, actors brought up
+    to date and forgetting their target, which may be a player elsewhere.
+    """
+    objects = []
+    for obj in list(area.objects):
+        spawn = area.spawns.get(id(obj))
+        # brings age and energy up to date
+        area.unregister(obj)
+        if isinstance(obj, Actor):
+            world.actor_area.pop(id(obj), None)
+            if isinstance(obj, Player):
+                continue
+            obj.target = None
+        objects.append((obj, spawn))
+    return area_state(area, objects)
+
+
+def area_state(area, objects):
+    return {
+        "id": area.id,
+        "name": area.name,
+        "depth": area.depth,
+        "time": area.time,
+        "terrain": area.terrain,
+        "path_graph": area.path_graph,
+        "objects": objects,
+        "journal": area.journal,
+        "origin": area.origin,
+    }
+
+
+def seed_record(world, area):
+    """
+    The record of a generated level without what its seed brings back: the journal
+    and the objects that did not spawn with the level
+    """
+    record = area_record(world, area)
+    record["objects"] = [(obj, spawn) for obj, spawn in record["objects"] if spawn is None]
+    del record["terrain"], record["path_graph"]
+    return record
+
+
+def unpack_area(record):
+    area = Area(record["name"], record["terrain"], record["depth"], area_id=record["id"])
+    area.time = record["time"]
+    area.path_graph = record["path_graph"]
+    area.journal = record["journal"]
+    area.origin = record["origin"]
+    return area
+
+
+def place_objects(world, area, record):
+    for obj, spawn in record["objects"]:
+        if isinstance(obj, Actor):
+            world.add_actor(obj, area=area)
+        area.add_object(obj, obj.x, obj.y)
+        if spawn is not None:
+            area.spawns[id(obj)] = spawn
+
+
+def pack(data, magic, version):
+    """
+    A header of magic, format version and uncompressed size ahead of the compressed data
+    """
+    return HEADER.pack(magic, version, len(data)) + zlib.compress(data, COMPRESSION)
+
+
+def unpack(f, magic, version):
+    file_magic, file_version, size = HEADER.unpack(f.read(HEADER.size))
+    if file_magic != magic or file_version != version:
+        raise ValueError("unsupported file {}".format(f.name))
+    return zlib.decompress(f.read(), bufsize=size)
+
+
+class AreaStore(object):
+    """
+    Unloads areas no player has been in for a while to compressed files and loads them
+    back when a door leads to them again. The first area of the world is always kept.
+
+    A file holds the compressed record of an area. A generated level is only stored
+    down to its seed and journal, and is generated again when it is loaded.
+    """
+
+    def __init__(self, path=STORE_PATH, idle_ticks=IDLE_TICKS, budget=RESIDENT_BUDGET):
+        self.path = path
+        self.idle_ticks = idle_ticks
+        self.budget = budget
+        # area id -> world age it last had players, least recently visited first
+        self.visited = collections.OrderedDict()
+        self.stored = set()
+        # area id -> origin of the stored areas that are generated again
+        self.origins = {}
+        # files being read by a snapshot are only removed once it is written
+        self.pinned = set()
+        self.unlinked = set()
+
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.
+        self.max_load_seconds = 0.
+        self.bytes_written = 0
+        self.resident_bytes = 0
+
+        # files left by a previous process refer to areas no door leads to any more
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith(".area"):
+                os.remove(os.path.join(path, name))
+
+    @property
+    def metrics(self):
+        return {
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "stored": len(self.stored),
+            "seeded": len(self.origins),
+            "load_seconds": self.load_seconds,
+            "mean_load_seconds": self.load_seconds / self.loads if self.loads else 0.,
+            "max_load_seconds": self.max_load_seconds,
+            "bytes_written": self.bytes_written,
+            "resident_bytes": self.resident_bytes,
+        }
+
+    def filename(self, area_id):
+        return os.path.join(self.path, "{}.area".format(area_id))
+
+    def visit(self, area_id, age):
+        self.visited[area_id] = age
+        self.visited.move_to_end(area_id)
+
+    def poll(self, world):
+        for area in world.areas:
+            if area.has_players:
+                self.visit(area.id, world.age)
+        if not world.age % STORE_INTERVAL:
+            self.unload_idle(world)
+
+    def unload_idle(self, world):
+        for area in world.areas:
+            if area.id not in self.visited:
+                self.visit(area.id, world.age)
+        self.resident_bytes = sum(footprint(area) for area in world.areas)
+
+        areas = {area.id: area for area in world.areas[1:] if not area.has_players}
+        for area_id, since in list(self.visited.items()):
+            area = areas.get(area_id)
+            if not area:
+                continue
+            if world.age - since < self.idle_ticks and self.resident_bytes <= self.budget:
+                break
+            self.resident_bytes -= footprint(area)
+            self.unload(world, area)
+
+    def unload(self, world, area):
+        start = time.perf_counter()
+        record = seed_record(world, area) if area.origin else area_record(world, area)
+        data = pack(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL), MAGIC, VERSION)
+        size = self.put(area.id, data, area.origin)
+
+        world.areas.remove(area)
+        AreaRegistry.pop(area.id, None)
+        self.visited.pop(area.id, None)
+        self.evictions += 1
+        self.bytes_written += size
+        log.info("unloaded %s, %d bytes in %.3fs", area, size, time.perf_counter() - start)
+
+    def put(self, area_id, data, origin=None):
+        """
+        Stores the packed record of an area, with the origin of the level it is
+        generated again from if it is one, returns its size
+        """
+        filename = self.filename(area_id)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(filename + ".tmp", filename)
+        self.stored.add(area_id)
+        self.unlinked.discard(area_id)
+        if origin:
+            self.origins[area_id] = origin
+        return len(data)
+
+    def pin(self, area_ids):
+        self.pinned.update(area_ids)
+
+    def unpin(self):
+        for area_id in self.unlinked:
+            os.remove(self.filename(area_id))
+        self.pinned.clear()
+        self.unlinked.clear()
+
+    def read(self, area_id):
+        with open(self.filename(area_id), "rb") as f:
+            return f.read()
+
+    def load(self, world, area_id):
+        if area_id not in self.stored:
+            return None
+        if area_id in self.origins:
+            # the level generator normally has it generated off the game loop first
+            door_class, depth, seed = self.origins[area_id][:3]
+            return self.rebuild(world, area_id, generate_level(door_class, depth, seed))
+
+        start = time.perf_counter()
+        record = self._read_record(area_id)
+        area = unpack_area(record)
+        world.areas.append(area)
+        return self._loaded(world, area, record, start)
+
+    def rebuild(self, world, area_id, level):
+        """
+        Brings back a level stored down to its seed from the level generated again
+        """
+        if area_id not in self.origins:
+            # loaded in the meantime
+            return AreaRegistry.get(area_id)
+        start = time.perf_counter()
+        record = self._read_record(area_id)
+        origin = self.origins.pop(area_id)
+        area = origin[0].rebuild_area(world, level, origin, area_id, record["journal"])
+        return self._loaded(world, area, record, start)
+
+    def _read_record(self, area_id):
+        with open(self.filename(area_id), "rb") as f:
+            return pickle.loads(unpack(f, MAGIC, VERSION))
+
+    def _loaded(self, world, area, record, start):
+        area_id = area.id
+        place_objects(world, area, record)
+
+        if area_id in self.pinned:
+            self.unlinked.add(area_id)
+        else:
+            os.remove(self.filename(area_id))
+        self.stored.discard(area_id)
+        self.visit(area_id, world.age)
+
+        elapsed = time.perf_counter() - start
+        self.loads += 1
+        self.load_seconds += elapsed
+        self.max_load_seconds = max(self.max_load_seconds, elapsed)
+        log.info("loaded %s in %.3fs", area, elapsed)
+        return area
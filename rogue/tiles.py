@@ -2,9 +2,12 @@ import io
 import os
 import collections
 import hashlib
+import array
 import dataclasses
 import yaml
 
+import numpy
+
 from PIL import Image
 
 from .util import StrEnum
@@ -126,9 +129,14 @@ class Tile(object):
 
 @dataclasses.dataclass
 class Door(Tile):
-    def __init__(self, key, area=None, position=None, message="a door", **kwargs):
+    """
+    Leads to a position in another area. The area is referred to by id so that it can
+    be unloaded while the door stays, the world loads it back when the door is used.
+    """
+
+    def __init__(self, key, area_id=None, position=None, message="a door", **kwargs):
         super(Door, self).__init__(key, **kwargs)
-        self.area = area
+        self.area_id = area_id
         self.position = position
         self.message = kwargs.pop("message", message)
 
@@ -136,12 +144,132 @@ class Door(Tile):
         return self.message
 
     def get_area(self, world, exit_area, exit_position):
-        if not self.area:
+        if not self.area_id:
             return ValueError("door needs area")
-        return self.area, self.position
+        return world.load_area(self.area_id), self.position
 
 
 class Trap(Tile):
+    def __init__(self, key, **kwargs):
+        super(Trap, self).__init__(key, **kwargs)
+        self.sprung = False
+
     def activate(self, actor, area):
+        if self.sprung:
+            return
         actor.notice("you stepped on a trap")
+        self.spring(area, actor.x, actor.y)
+
+    def spring(self, area, x, y):
+        self.sprung = True
         self.key = "lava1"
+        area.set_tile(x, y, self)
+        area.record("trap", x, y)
+
+
+class TileGrid(object):
+    """
+    Compact terrain storage for an area.
+
+    Each cell is stored as an index into the grid's key table along with its blocked and
+    blocked_sight flags, each layer a flat buffer with a (height, width) numpy view over
+    it. Only special tiles such as doors and traps are kept as objects in a side table,
+    plain cells are served from shared, read only flyweight tiles.
+    """
+
+    def __init__(self, width, height, key=None, blocked=False, blocked_sight=False):
+        self.width = width
+        self.height = height
+
+        self.keys = []
+        self.key_index = {}
+        self.special = {}
+        self.flyweights = {}
+
+        size = width * height
+        self.key_cells = array.array("H", [self.intern(key) if key else 0]) * size
+        self.blocked_cells = bytearray([blocked]) * size
+        self.blocked_sight_cells = bytearray([blocked_sight]) * size
+
+        self._views()
+
+    def _views(self):
+        shape = (self.height, self.width)
+        self.key_ids = numpy.frombuffer(self.key_cells, dtype=numpy.uint16).reshape(shape)
+        self.blocked = numpy.frombuffer(self.blocked_cells, dtype=numpy.bool_).reshape(shape)
+        self.blocked_sight = numpy.frombuffer(self.blocked_sight_cells, dtype=numpy.bool_).reshape(shape)
+
+    def __getstate__(self):
+        # the views would be pickled as copies no longer sharing the buffers
+        state = dict(self.__dict__)
+        for name in ("key_ids", "blocked", "blocked_sight"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    @classmethod
+    def from_palette(cls, palette, cells):
+        """
+        Builds a grid from a (height, width) array of indexes into a list of plain tiles
+        """
+        height, width = cells.shape
+        grid = cls(width, height)
+        grid.key_ids[:] = numpy.array([grid.intern(tile.key) for tile in palette], dtype=numpy.uint16)[cells]
+        grid.blocked[:] = numpy.array([tile.blocked for tile in palette], dtype=numpy.bool_)[cells]
+        grid.blocked_sight[:] = numpy.array([tile.blocked_sight for tile in palette], dtype=numpy.bool_)[cells]
+        return grid
+
+    @classmethod
+    def from_rows(cls, rows):
+        grid = cls(len(rows[0]), len(rows))
+        for y, row in enumerate(rows):
+            for x, tile in enumerate(row):
+                grid.set(x, y, tile)
+        return grid
+
+    def intern(self, key):
+        idx = self.key_index.get(key)
+        if idx is None:
+            idx = self.key_index[key] = len(self.keys)
+            self.keys.append(key)
+        return idx
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get(self, x, y):
+        pos = (x, y)
+        tile = self.special.get(pos)
+        if tile:
+            return tile
+
+        i = y * self.width + x
+        flyweight = (self.key_cells[i], self.blocked_cells[i], self.blocked_sight_cells[i])
+        tile = self.flyweights.get(flyweight)
+        if not tile:
+            key_id, blocked, blocked_sight = flyweight
+            tile = self.flyweights[flyweight] = Tile(self.keys[key_id], blocked=bool(blocked), blocked_sight=bool(blocked_sight))
+        return tile
+
+    def set(self, x, y, tile):
+        i = y * self.width + x
+        self.key_cells[i] = self.intern(tile.key)
+        self.blocked_cells[i] = tile.blocked
+        self.blocked_sight_cells[i] = tile.blocked_sight
+
+        if type(tile) is Tile:
+            self.special.pop((x, y), None)
+        else:
+            self.special[(x, y)] = tile
+
+    def get_key(self, x, y):
+        return self.keys[self.key_cells[y * self.width + x]]
+
+    def is_blocked(self, x, y):
+        return self.blocked_cells[y * self.width + x]
+
+    def is_blocked_sight(self, x, y):
+        return self.blocked_sight_cells[y * self.width + x]
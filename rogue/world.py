@@ -1,78 +1,222 @@
-import math
 import time
+import array
 import random
 import itertools
 import collections
 import logging
 import heapq
 
-from typing import Set, Dict, List, DefaultDict
+from typing import List
 
 from .actor import Player, Actor
-from .tiles import Tile
+from .tiles import TileGrid
 from .actions import ActionError
+from .fov import compute_fov
+from .hpa import ClusterGraph
+from .dijkstra import FlowField
+from .chunks import TerrainChunks
+from .interest import InterestGrid
+from .messages import SharedMessage
 from .annotations import NodeType
 from . import util
 
 TIMEOUT = .1
 DAY = 86400 / 6. * TIMEOUT
 
+DORMANT_BUCKET = 16
+
+PATH_BUDGET = 2000
+HIERARCHY_DISTANCE = 32
+LEG_HOPS = 4
+NEIGHBORS = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]
+
 AreaRegistry = {}
 
 log = logging.getLogger(__name__)
 
 
 class Area(object):
-    def __init__(self, name, tiles, depth):
-        self.id = util.generate_uid()
+    def __init__(self, name, tiles, depth, area_id=None):
+        self.id = area_id or util.generate_uid()
         self.name = name
-        self.tiles = tiles
+        self.terrain = tiles if isinstance(tiles, TileGrid) else TileGrid.from_rows(tiles)
         self.depth = depth
+
+        # position -> objects in draw order, actors first
         self.object_index = collections.defaultdict(list)
+
+        # live registries keyed by id() as objects are unhashable dataclasses
+        self.player_registry = {}
+        self.actor_registry = {}
+        self.inert_registry = {}
+
+        # actors are only woken on the tick they have charged enough energy to act,
+        # energy and age are brought up to date lazily when they are
+        self.wakeup_queue = []
+        self.wakeups = {}
+        self.charged_at = {}
+        self.aged_at = {}
+        self.counter = itertools.count()
+
+        # actors out of reach of every player sleep in coarse buckets until one comes near
+        self.dormant = collections.defaultdict(dict)
+        self.dormant_since = {}
+        self.dormant_reach = 0
+
         self.time = 0
+        # ids of the areas entered from this one
         self.areas = []
+        self._path_arena = None
+        self.path_graph = None
+        self.flow_field = FlowField(self)
+        self._chunks = None
+        self.interest = InterestGrid()
+
+        # id(object) -> index into the spawns of a generated level, and what happened
+        # to the level since as compact tuples, enough to regenerate it from its seed
+        self.spawns = {}
+        self.journal = []
+        # (door class, depth, seed, exit area id, exit position) of a generated level
+        self.origin = None
         AreaRegistry[self.id] = self
 
     def __str__(self):
         return "{} level {}".format(self.name, self.depth)
 
     def add_area(self, area):
-        self.areas.append(area)
+        if area.id not in self.areas:
+            self.areas.append(area.id)
 
     @property
     def objects(self):
-        return itertools.chain.from_iterable(self.object_index.values())
+        return itertools.chain(self.actor_registry.values(), self.inert_registry.values())
 
     @property
     def players(self):
-        return (o for o in self.objects if isinstance(o, Player))
+        return self.player_registry.values()
+
+    @property
+    def actors(self):
+        return self.actor_registry.values()
 
     @property
     def has_players(self):
-        return any(self.players)
+        return len(self.player_registry) > 0
+
+    def register(self, obj):
+        key = id(obj)
+        if key in self.actor_registry or key in self.inert_registry:
+            return
+
+        self.aged_at[key] = self.time
+        if isinstance(obj, Actor):
+            self.actor_registry[key] = obj
+            if isinstance(obj, Player):
+                self.player_registry[key] = obj
+            self.charged_at[key] = self.time
+            self.schedule_actor(obj)
+        else:
+            self.inert_registry[key] = obj
+
+    def unregister(self, obj):
+        key = id(obj)
+        if key in self.aged_at:
+            self.sync_age(obj)
+        if key in self.charged_at:
+            self.sync_energy(obj)
+        if key in self.dormant_since:
+            _, bucket = self.dormant_since.pop(key)
+            self.dormant[bucket].pop(key, None)
+        if key in self.player_registry:
+            self.interest.remove(obj)
+        for registry in (self.player_registry, self.actor_registry, self.inert_registry,
+                         self.wakeups, self.charged_at, self.aged_at):
+            registry.pop(key, None)
+
+    def sync_age(self, obj):
+        key = id(obj)
+        obj.age += self.time - self.aged_at[key]
+        self.aged_at[key] = self.time
+
+    def sync_energy(self, actor):
+        key = id(actor)
+        actor.charge_energy(self.time - self.charged_at[key])
+        self.charged_at[key] = self.time
+
+    def near_player(self, actor, radius):
+        return any(max(abs(player.x - actor.x), abs(player.y - actor.y)) <= radius for player in self.players)
+
+    def sleep(self, actor):
+        key = id(actor)
+        bucket = (actor.x // DORMANT_BUCKET, actor.y // DORMANT_BUCKET)
+        self.dormant[bucket][key] = actor
+        self.dormant_since[key] = (self.time, bucket)
+        self.dormant_reach = max(self.dormant_reach, actor.AWARENESS)
+
+    def wake(self, actor):
+        since, bucket = self.dormant_since.pop(id(actor))
+        self.dormant[bucket].pop(id(actor))
+        actor.wake(self, self.time - since)
+        self.schedule_actor(actor)
+
+    def wake_nearby(self, player):
+        reach = -(-self.dormant_reach // DORMANT_BUCKET)
+        bx, by = player.x // DORMANT_BUCKET, player.y // DORMANT_BUCKET
+        for y in range(by - reach, by + reach + 1):
+            for x in range(bx - reach, bx + reach + 1):
+                sleepers = self.dormant.get((x, y))
+                if not sleepers:
+                    continue
+                for actor in list(sleepers.values()):
+                    if max(abs(player.x - actor.x), abs(player.y - actor.y)) <= actor.AWARENESS:
+                        self.wake(actor)
+
+    def schedule_actor(self, actor):
+        at = self.time + actor.ticks_to_act
+        self.wakeups[id(actor)] = at
+        heapq.heappush(self.wakeup_queue, (at, next(self.counter), actor))
 
     @property
     def map_width(self):
-        return len(self.tiles[0])
+        return self.terrain.width
 
     @property
     def map_height(self):
-        return len(self.tiles)
+        return self.terrain.height
 
     def get_tile(self, x, y):
-        if x < 0 or x >= self.map_width or y < 0 or y >= self.map_height:
+        if not self.terrain.in_bounds(x, y):
             return None
-        return self.tiles[y][x]
+        return self.terrain.get(x, y)
+
+    def set_tile(self, x, y, tile):
+        was_blocked = self.terrain.is_blocked(x, y)
+        self.terrain.set(x, y, tile)
+        if self.path_graph and was_blocked != tile.blocked:
+            self.path_graph.invalidate(x, y)
+        if self._chunks:
+            self._chunks.invalidate(x, y)
 
     def get_objects(self, x, y):
         return self.object_index.get((x, y), [])
 
+    def objects_within(self, left, top, right, bottom):
+        """
+        Yields the position and objects of each occupied cell of the rectangle, row
+        by row, the objects in draw order
+        """
+        index = self.object_index
+        for y in range(max(top, 0), min(bottom, self.map_height)):
+            for x in range(max(left, 0), min(right, self.map_width)):
+                objs = index.get((x, y))
+                if objs:
+                    yield (x, y), objs
+
     def has_objects(self, x, y):
         return len(self.get_objects(x, y)) > 0
 
     def is_tile_free(self, x, y, ignore=None):
-        tile = self.get_tile(x, y)
-        if not tile or tile.blocked:
+        if not self.terrain.in_bounds(x, y) or self.terrain.is_blocked(x, y):
             return False
 
         objs = self.get_objects(x, y)
@@ -88,33 +232,55 @@ class Area(object):
     def remove_object(self, obj):
         objs = self.get_objects(obj.x, obj.y)
         objs.remove(obj)
+        self.unregister(obj)
+        spawn = self.spawns.pop(id(obj), None)
+        if spawn is not None:
+            self.record("taken", spawn)
+
+    def record(self, *entry):
+        self.journal.append(entry)
 
     def tick(self, world):
         self.time += 1
-        for obj in list(self.objects):
-            obj.age += 1
-            if not isinstance(obj, Actor):
-                continue
-            if not obj.is_alive:
+        while self.wakeup_queue and self.wakeup_queue[0][0] <= self.time:
+            at, _, actor = heapq.heappop(self.wakeup_queue)
+            key = id(actor)
+            if self.wakeups.get(key) != at:
                 continue
-            obj.charge_energy()
-            if not obj.can_act:
+            del self.wakeups[key]
+
+            self.sync_age(actor)
+            self.sync_energy(actor)
+            if not actor.is_alive:
                 continue
-            action = obj.get_action(world)
-            if not action:
+
+            if actor.AWARENESS and not self.near_player(actor, actor.AWARENESS):
+                self.sleep(actor)
                 continue
-            try:
-                action.perform(obj, world)
-                obj.drain_energy()
-            except ActionError as e:
-                obj.notice(str(e))
-            except Exception:
-                log.exception("error performing action %s", action)
-
-    def place(self, obj):
+
+            self.act(world, actor)
+
+            if key in self.actor_registry and key not in self.wakeups:
+                self.schedule_actor(actor)
+
+    def act(self, world, actor):
+        if not actor.can_act:
+            return
+        action = actor.get_action(world)
+        if not action:
+            return
+        try:
+            action.perform(actor, world)
+            actor.drain_energy()
+        except ActionError as e:
+            actor.notice(str(e))
+        except Exception:
+            log.exception("error performing action %s", action)
+
+    def place(self, obj, rng=random):
         for _ in range(100):
-            x = random.randrange(0, self.map_width)
-            y = random.randrange(0, self.map_height)
+            x = rng.randrange(0, self.map_width)
+            y = rng.randrange(0, self.map_height)
 
             if self.is_tile_free(x, y):
                 self.add_object(obj, x, y)
@@ -123,8 +289,10 @@ class Area(object):
 
     def immediate_area(self, actor, radius=1):
         immediate = [(actor.x, actor.y)]
-        for dy in range(-radius, radius):
-            for dx in range(-radius, radius):
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                if not dx and not dy:
+                    continue
                 x = actor.x + dx
                 y = actor.y + dy
                 if x < 0 or x >= self.map_width or y < 0 or y >= self.map_height:
@@ -139,32 +307,56 @@ class Area(object):
         return objects
 
     def broadcast(self, actor):
-        for obj in self.immediate_area_objects(actor, radius=10):
-            if isinstance(obj, Actor):
-                obj.notify()
+        for player in self.interest.observers(actor.x, actor.y):
+            player.notify()
+
+    def publish(self, x, y, event_name, **msg):
+        """
+        Delivers an event at a position to the players observing it, all of them
+        receiving the same message, encoded once
+        """
+        observers = self.interest.observers(x, y)
+        if not observers:
+            return
+        msg["_event"] = event_name
+        shared = SharedMessage(msg)
+        for player in observers:
+            player.receive(shared)
 
     def fov(self, actor):
-        visible = [(actor.x, actor.y)]
-        for theta in range(361):
-            ax = math.cos(math.radians(theta))
-            ay = math.sin(math.radians(theta))
-            for i in range(1, actor.attributes.view_distance):
-                px = actor.x + int(round(i * ax))
-                py = actor.y + int(round(i * ay))
-                if px < 0 or px >= self.map_width or py < 0 or py >= self.map_height:
-                    continue
-                tile = self.get_tile(px, py)
-                pos = (px, py)
-                if pos not in visible:
-                    visible.append(pos)
-                if tile.blocked_sight or any(obj.blocks_sight for obj in self.get_objects(px, py)):
-                    break
+        def _blocks_sight(x, y):
+            objs = self.object_index.get((x, y))
+            return bool(objs) and any(obj.blocks_sight for obj in objs)
 
-        return visible
+        return compute_fov(self.terrain.blocked_sight_cells, self.map_width, self.map_height,
+                           actor.x, actor.y, actor.attributes.view_distance, _blocks_sight)
 
-    def find_path(self, actor, waypoint):
-        rv = find_path(self, actor.pos, waypoint, actor)
-        return rv
+    @property
+    def path_arena(self):
+        if not self._path_arena:
+            self._path_arena = PathArena(self.map_width, self.map_height)
+        return self._path_arena
+
+    def terrain_chunks(self, tileset):
+        if not self._chunks or self._chunks.tileset is not tileset:
+            self._chunks = TerrainChunks(self.terrain, tileset)
+        return self._chunks
+
+    def build_path_graph(self):
+        self.path_graph = ClusterGraph(self.terrain)
+        self.path_graph.build()
+
+    def find_path(self, actor, waypoint, max_nodes=PATH_BUDGET):
+        rv = None
+        if not self.path_graph or _path_score(actor.pos, waypoint) <= HIERARCHY_DISTANCE:
+            rv = find_path(self, actor.pos, waypoint, actor, max_nodes=max_nodes)
+            if rv.complete or not self.path_graph:
+                return rv
+
+        route = self.path_graph.find_route(actor.pos, waypoint)
+        if route:
+            return find_path_leg(self, route, actor, max_nodes=max_nodes)
+        return rv or find_path(self, actor.pos, waypoint, actor, max_nodes=max_nodes)
 
     def generate_map(self, actor):
         rows = []
@@ -194,10 +386,16 @@ class Area(object):
         obj.y = y
         objs = self.object_index[(obj.x, obj.y)]
         if obj not in objs:
-            objs.append(obj)
-        tile = self.tiles[y][x]
+            if isinstance(obj, Actor):
+                objs.insert(next((i for i, o in enumerate(objs) if not isinstance(o, Actor)), len(objs)), obj)
+            else:
+                objs.append(obj)
+        self.register(obj)
         if isinstance(obj, Player):
-            tile.activate(obj, self)
+            self.interest.update(obj, obj.attributes.view_distance)
+            self.terrain.get(x, y).activate(obj, self)
+            if self.dormant_since:
+                self.wake_nearby(obj)
 
 
 class World(object):
@@ -207,14 +405,17 @@ class World(object):
         self.age = 0
         self.schedules = []
         self.counter = itertools.count()
+        self.player_registry = {}
+        self.levels = None
+        self.store = None
 
     @property
     def players(self):
-        return itertools.chain.from_iterable(area.players for area in self.areas)
+        return list(self.player_registry.values())
 
     @property
     def num_players(self):
-        return sum(1 for _ in self.players)
+        return len(self.player_registry)
 
     def add_actor(self, actor, area=None):
         if not area:
@@ -222,35 +423,66 @@ class World(object):
         if area not in self.areas:
             self.areas.append(area)
         self.actor_area[id(actor)] = area
+        if isinstance(actor, Player):
+            self.player_registry[id(actor)] = actor
         return area
 
-    def place_actor(self, actor: Actor, area: Area = None):
+    def place_actor(self, actor: Actor, area: Area = None, rng=random):
         actor.stats.born = self.age
-        self.add_actor(actor, area=area).place(actor)
+        self.add_actor(actor, area=area).place(actor, rng)
 
     def remove_actor(self, actor: Actor):
         area = self.get_area(actor)
         area.remove_object(actor)
         self.actor_area.pop(id(actor))
+        self.player_registry.pop(id(actor), None)
+
+    def publish(self, event_name, **msg):
+        """
+        Delivers an event to every player of the world, all of them receiving the
+        same message, encoded once
+        """
+        msg["_event"] = event_name
+        shared = SharedMessage(msg)
+        for player in self.players:
+            player.receive(shared)
 
     def get_area(self, actor: Actor):
         return self.actor_area.get(id(actor))
 
+    def load_area(self, area_id):
+        area = AreaRegistry.get(area_id)
+        if not area and self.store:
+            area = self.store.load(self, area_id)
+        return area
+
     def tick(self):
+        if self.levels:
+            self.levels.poll(self)
+        if self.store:
+            self.store.poll(self)
+
         active_areas = [area for area in self.areas if area.has_players]
         for area in active_areas:
             area.tick(self)
 
         if self.schedules:
             while self.schedules and self.schedules[0][0] <= self.age:
-                _, _, callback = heapq.heappop(self.schedules)
-                callback()
+                _, _, callback, args = heapq.heappop(self.schedules)
+                callback(self, *args)
+
+        for player in self.players:
+            player.flush()
 
         self.age += 1
 
-    def schedule(self, timeout, callback):
+    def schedule(self, timeout, callback, *args):
+        """
+        Calls back with the world and args after timeout ticks. Callbacks are module
+        level functions and args plain values so that schedules can be saved.
+        """
         at = self.age + timeout
-        heapq.heappush(self.schedules, (at, next(self.counter), callback))
+        heapq.heappush(self.schedules, (at, next(self.counter), callback, args))
 
     def fov(self, actor: Actor):
         area = self.get_area(actor)
@@ -277,68 +509,127 @@ class World(object):
 
 # https://en.wikipedia.org/wiki/A*_search_algorithm#Pseudocode
 
+class Path(collections.namedtuple("Path", ["steps", "complete"])):
+    """
+    Steps from the start (exclusive) toward the goal, complete is False when the search
+    ran out of budget or the goal is unreachable and the steps only lead to the node
+    closest to the goal.
+    """
+
+
+class PathArena(object):
+    """
+    Flat per cell score and parent buffers reused across searches of an area. Cells are
+    only valid for the search whose generation they are stamped with, so nothing needs
+    to be cleared between searches.
+    """
+
+    MAX_GENERATION = 2 ** 32 - 1
+
+    def __init__(self, width, height):
+        size = width * height
+        self.score = array.array("i", [0]) * size
+        self.parent = array.array("i", [-1]) * size
+        self.seen = array.array("I", [0]) * size
+        self.closed = array.array("I", [0]) * size
+        self.generation = 0
+
+    def begin(self):
+        self.generation += 1
+        if self.generation >= self.MAX_GENERATION:
+            self.generation = 1
+            size = len(self.seen)
+            self.seen = array.array("I", [0]) * size
+            self.closed = array.array("I", [0]) * size
+        return self.generation
+
+
+# every MoveAction costs the same regardless of direction, so chebyshev distance is exact
+# on an open map
 def _path_score(a: NodeType, b: NodeType) -> int:
-    ax, ay = a
-    bx, by = b
-    return abs(bx - ax) + abs(by - ay)
+    return max(abs(b[0] - a[0]), abs(b[1] - a[1]))
 
 
-def _total_path(came_from: Dict[NodeType, NodeType], node: NodeType) -> List[NodeType]:
-    total = [node]
-    while node in came_from:
-        node = came_from[node]
-        total.append(node)
-    return list(reversed(total))[1:]
+def _total_path(arena: PathArena, width: int, node: int) -> List[NodeType]:
+    total = []
+    parent = arena.parent
+    while parent[node] != -1:
+        total.append((node % width, node // width))
+        node = parent[node]
+    total.reverse()
+    return total
 
 
-def find_path(area: Area, start: NodeType, goal: NodeType, ignore) -> List[NodeType]:
-    open_nodes: Set[NodeType] = set()
-    open_nodes.add(start)
+def find_path(area: Area, start: NodeType, goal: NodeType, ignore, max_nodes: int = PATH_BUDGET) -> Path:
+    if start == goal:
+        return Path([], True)
 
-    closed_nodes: Set[NodeType] = set()
+    width = area.map_width
+    height = area.map_height
+    arena = area.path_arena
+    search = arena.begin()
+    score, parent, seen, closed = arena.score, arena.parent, arena.seen, arena.closed
 
-    came_from = {}
-    score = {start: 0}
+    ignore = [ignore]
+    goal_node = goal[1] * width + goal[0]
+    start_node = start[1] * width + start[0]
 
-    total: DefaultDict[NodeType, float] = collections.defaultdict(lambda: math.inf)
-    total[start] = _path_score(start, goal)
+    seen[start_node] = search
+    score[start_node] = 0
+    parent[start_node] = -1
 
-    def _next() -> NodeType:
-        return sorted(open_nodes, key=lambda n: _path_score(n, goal)).pop(0)
+    estimate = _path_score(start, goal)
+    open_nodes = [(estimate, estimate, start_node)]
+    closest, closest_estimate = start_node, estimate
 
     evaluated = 0
     while open_nodes:
-        node: NodeType = _next()
+        _, estimate, node = heapq.heappop(open_nodes)
+        if closed[node] == search:
+            continue
+        closed[node] = search
 
-        if node == goal:
-            return _total_path(came_from, node)
+        if node == goal_node:
+            return Path(_total_path(arena, width, node), True)
 
-        open_nodes.remove(node)
-        closed_nodes.add(node)
-        x, y = node
+        if estimate < closest_estimate:
+            closest, closest_estimate = node, estimate
 
-        if not area.is_tile_free(x, y, [ignore]):
-            continue
+        evaluated += 1
+        if evaluated > max_nodes:
+            break
+
+        y, x = divmod(node, width)
+        new_score = score[node] + 1
+        for dx, dy in NEIGHBORS:
+            nx = x + dx
+            ny = y + dy
+            if nx < 0 or nx >= width or ny < 0 or ny >= height:
+                continue
 
-        for dy in (-1, 0, 1):
-            for dx in (-1, 0, 1):
-                neighbor: NodeType = (x + dx, y + dy)
-                neighbor_tile: Tile = area.get_tile(*neighbor)
+            neighbor = ny * width + nx
+            if closed[neighbor] == search:
+                continue
+            if neighbor != goal_node and not area.is_tile_free(nx, ny, ignore):
+                continue
 
-                if not neighbor_tile:
-                    continue
-                if neighbor in closed_nodes:
-                    continue
+            if seen[neighbor] == search and new_score >= score[neighbor]:
+                continue
 
-                new_score = score[node] + _path_score(node, neighbor)
-                if neighbor not in open_nodes:
-                    open_nodes.add(neighbor)
-                elif new_score >= total[neighbor]:
-                    continue
+            seen[neighbor] = search
+            score[neighbor] = new_score
+            parent[neighbor] = node
+            estimate = _path_score((nx, ny), goal)
+            heapq.heappush(open_nodes, (new_score + estimate, estimate, neighbor))
 
-                came_from[neighbor] = node
-                score[neighbor] = new_score
-                total[neighbor] = new_score + _path_score(neighbor, goal)
-        evaluated += 1
-        if evaluated > 1000:
-            return
+    return Path(_total_path(arena, width, closest), False)
+
+
+def find_path_leg(area: Area, route: List[NodeType], ignore, max_nodes: int = PATH_BUDGET) -> Path:
+    """
+    Refines only the start of an abstract route, a few portals along. The returned path
+    is only complete when that reaches the goal.
+    """
+    leg = route[min(LEG_HOPS, len(route) - 1)]
+    path = find_path(area, route[0], leg, ignore, max_nodes=max_nodes)
+    return Path(path.steps, path.complete and leg == route[-1])
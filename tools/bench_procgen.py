@@ -0,0 +1,33 @@
+import sys
+import time
+import random
+
+from rogue import procgen
+
+SIZES = [200, 500, 1000]
+MIN_SIZE = 4
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    random.seed(0)
+
+    print("{:>6} {:>10} {:>10} {:>10}".format("size", "map", "cave", "dungeon"))
+    for size in sizes:
+        print("{:>6} {:>9.3f}s {:>9.3f}s {:>9.3f}s".format(
+            size,
+            timed(procgen.generate_map, size),
+            timed(procgen.generate_cave, size, size),
+            timed(procgen.generate_dungeon, size, size, MIN_SIZE),
+        ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,11 +5,10 @@ WIDTH, HEIGHT = 120, 40
 MIN_SIZE = 4
 
 
-def print_dungeon(rows):
-    return "\n".join(["".join([" " if inside else "#" for inside in row]) for row in rows])
+def print_dungeon(tiles):
+    return "\n".join(["".join([" " if not blocked else "#" for blocked in row]) for row in tiles.blocked])
 
 
-rooms, tunnels = procgen.generate_dungeon(WIDTH, HEIGHT, MIN_SIZE)
-rows = procgen.render_dungeon(WIDTH, HEIGHT, rooms, tunnels)
+tiles = procgen.generate_dungeon(WIDTH, HEIGHT, MIN_SIZE)
 
-print(print_dungeon(rows))
+print(print_dungeon(tiles))
@@ -7,6 +7,8 @@ import {sprintf} from 'sprintf-js';
 const API_URL = process.env.REACT_APP_API;
 const PING_DELAY = 10;
 const LOG_LIMIT = 10;
+const FEATURES = ["delta", "packed", "chunks", "batch"];
+const CHUNK_SIZE = 32;
 
 enum PlayerState {
   DISCONNECTED = 0,
@@ -141,6 +143,11 @@ interface ServerMessage {
 
 interface FrameUpdateMessage extends ServerMessage {
   id: string;
+  seq: number;
+  base?: number;
+  delta?: any[][];
+  packed?: PackedFrame;
+  packed_delta?: Uint8Array;
   frame: any[][][];
   width: number;
   height: number;
@@ -148,6 +155,41 @@ interface FrameUpdateMessage extends ServerMessage {
   y: number;
 }
 
+interface PackedFrame {
+  width: number;
+  height: number;
+  fov: Uint8Array;
+  tiles?: Uint8Array;
+  objects: Uint8Array;
+}
+
+interface ChunkMessage extends ServerMessage {
+  id: string;
+  x: number;
+  y: number;
+  width: number;
+  height: number;
+  hash: string;
+  tiles?: Uint8Array;
+}
+
+interface TerrainChunk {
+  width: number;
+  tiles: Int16Array;
+}
+
+type ChunkCache = {
+  [hash: string]: TerrainChunk;
+}
+
+type ChunkIndex = {
+  [key: string]: string;
+}
+
+type FrameHistory = {
+  [seq: number]: FrameUpdateMessage;
+}
+
 interface NoticeMessage extends ServerMessage {
   notice: string;
   mood: boolean;
@@ -176,6 +218,9 @@ class DataStore {
   log: LogMessage[];
   maps: MapManager;
   lastMapId?: string;
+  frameHistory: FrameHistory;
+  chunks: ChunkCache;
+  chunkIndex: ChunkIndex;
 
   constructor() {
     this.responseCallbacks = {};
@@ -188,6 +233,9 @@ class DataStore {
       playSounds: true
     };
     this.maps = {};
+    this.frameHistory = {};
+    this.chunks = {};
+    this.chunkIndex = {};
     this.log = [];
   }
 
@@ -254,7 +302,7 @@ class DataStore {
       }
 
       this.pingIntervalId = window.setInterval(this.onPing.bind(this), PING_DELAY * 1000);
-      this.socket.send(encode({"profile": profile}));
+      this.socket.send(encode({"profile": profile, "features": FEATURES, "chunks": Object.keys(this.chunks)}));
       view.onConnected(event);
     });
 
@@ -262,19 +310,12 @@ class DataStore {
       const msg = decode(event.data);
       this.bytes += event.data.byteLength;
 
-      if (msg._id && this.responseCallbacks[msg._id]) {
-        this.responseCallbacks[msg._id](msg);
-        delete this.responseCallbacks[msg._id];
-      } else if (msg._event && this.eventCallbacks[msg._event]) {
-
-        if (msg._event === "frame") {
-          this.frames++;
-          this.updateMap(msg);
-        } else if (msg._event === "notice") {
-          this.addLog(LogType.NOTICE, msg.notice);
-        }
-
-        this.eventCallbacks[msg._event](msg);
+      // batches bundle several messages in one array
+      if (Array.isArray(msg)) {
+        for (const item of msg)
+          this.handleMessage(item);
+      } else {
+        this.handleMessage(msg);
       }
     });
 
@@ -291,6 +332,31 @@ class DataStore {
     });
   }
 
+  handleMessage(msg: any) {
+    if (msg._event === "chunk") {
+      this.addChunk(msg);
+    } else if (msg._id && this.responseCallbacks[msg._id]) {
+      this.responseCallbacks[msg._id](msg);
+      delete this.responseCallbacks[msg._id];
+    } else if (msg._event && this.eventCallbacks[msg._event]) {
+
+      if (msg._event === "frame") {
+        this.frames++;
+        if (msg.packed)
+          this.unpackFrame(msg);
+        else if (msg.packed_delta)
+          this.unpackDelta(msg);
+        this.applyDelta(msg);
+        this.fillTerrain(msg);
+        this.updateMap(msg);
+      } else if (msg._event === "notice") {
+        this.addLog(LogType.NOTICE, msg.notice);
+      }
+
+      this.eventCallbacks[msg._event](msg);
+    }
+  }
+
   send(obj: any, callback?: ResponseCallback) {
     // console.log(obj);
     if (!this.socket || this.socket.readyState !== 1) {
@@ -322,6 +388,125 @@ class DataStore {
       this.settings = JSON.parse(settings);
   }
 
+  applyDelta(msg: FrameUpdateMessage) {
+    // delta frames patch the cells that changed since an acknowledged frame
+    if (msg.base !== undefined && msg.delta) {
+      const base = this.frameHistory[msg.base];
+      const height = base.frame.length;
+      const width = base.frame[0].length;
+      const offset_x = msg.x - base.x;
+      const offset_y = msg.y - base.y;
+
+      const frame = new Array(height);
+      for (let y=0; y<height; y++) {
+        const base_row = base.frame[y + offset_y];
+        frame[y] = new Array(width);
+        for (let x=0; x<width; x++) {
+          frame[y][x] = base_row ? base_row[x + offset_x] : undefined;
+        }
+      }
+
+      for (const change of msg.delta) {
+        const idx = change[0];
+        frame[Math.floor(idx / width)][idx % width] = change.slice(1);
+      }
+      msg.frame = frame;
+    }
+
+    const oldest = msg.base !== undefined ? msg.base : msg.seq;
+    for (const seq of Object.keys(this.frameHistory)) {
+      if (Number(seq) < oldest)
+        delete this.frameHistory[Number(seq)];
+    }
+    this.frameHistory[msg.seq] = msg;
+    this.send({ack: msg.seq});
+  }
+
+  unpackFrame(msg: FrameUpdateMessage) {
+    // packed frames carry little endian planes, rebuilt here into frame cells
+    const packed = msg.packed as PackedFrame;
+    const width = packed.width;
+    // streamed terrain is left out, fillTerrain supplies it from the chunks
+    const tiles = packed.tiles ? new DataView(packed.tiles.buffer, packed.tiles.byteOffset, packed.tiles.byteLength) : undefined;
+    const objects = new DataView(packed.objects.buffer, packed.objects.byteOffset, packed.objects.byteLength);
+
+    const frame = new Array(packed.height);
+    for (let y=0; y<packed.height; y++) {
+      frame[y] = new Array(width);
+      for (let x=0; x<width; x++) {
+        const idx = y * width + x;
+        frame[y][x] = [packed.fov[idx] === 1, tiles ? tiles.getInt16(idx * 2, true) : -1, -1];
+      }
+    }
+
+    let offset = 0;
+    while (offset < objects.byteLength) {
+      const idx = objects.getInt16(offset, true);
+      const count = objects.getInt16(offset + 2, true);
+      const cell = frame[Math.floor(idx / width)][idx % width];
+      cell.length = 2;
+      for (let i=0; i<count; i++) {
+        cell.push(objects.getInt16(offset + 4 + i * 2, true));
+      }
+      offset += 4 + count * 2;
+    }
+    msg.frame = frame;
+  }
+
+  unpackDelta(msg: FrameUpdateMessage) {
+    // packed deltas list (cell index, object count, fov, tile index, *object indexes)
+    const packed = msg.packed_delta as Uint8Array;
+    const view = new DataView(packed.buffer, packed.byteOffset, packed.byteLength);
+    const delta = [];
+    let offset = 0;
+    while (offset < view.byteLength) {
+      const idx = view.getInt16(offset, true);
+      const count = view.getInt16(offset + 2, true);
+      const change = [idx, view.getInt16(offset + 4, true) === 1, view.getInt16(offset + 6, true)];
+      for (let i=0; i<count; i++) {
+        change.push(view.getInt16(offset + 8 + i * 2, true));
+      }
+      if (!count)
+        change.push(-1);
+      delta.push(change);
+      offset += 8 + count * 2;
+    }
+    msg.delta = delta;
+  }
+
+  addChunk(msg: ChunkMessage) {
+    if (msg.tiles) {
+      const tiles = new Int16Array(msg.width * msg.height);
+      const view = new DataView(msg.tiles.buffer, msg.tiles.byteOffset, msg.tiles.byteLength);
+      for (let i=0; i<tiles.length; i++) {
+        tiles[i] = view.getInt16(i * 2, true);
+      }
+      this.chunks[msg.hash] = {width: msg.width, tiles: tiles};
+    }
+    this.chunkIndex[sprintf("%s:%s:%s", msg.id, msg.x, msg.y)] = msg.hash;
+  }
+
+  fillTerrain(msg: FrameUpdateMessage) {
+    // terrain comes in chunks when streamed, frames only carry fov and objects
+    if (!FEATURES.includes("chunks"))
+      return;
+
+    const height = msg.frame.length;
+    const width = msg.frame[0].length;
+    const size = CHUNK_SIZE;
+    for (let y=0; y<height; y++) {
+      const ty = msg.y - Math.floor(height / 2) + y;
+      for (let x=0; x<width; x++) {
+        const cell = msg.frame[y][x];
+        const tx = msg.x - Math.floor(width / 2) + x;
+        const cx = Math.floor(tx / size) * size;
+        const cy = Math.floor(ty / size) * size;
+        const chunk = cell[0] ? this.chunks[this.chunkIndex[sprintf("%s:%s:%s", msg.id, cx, cy)]] : undefined;
+        cell[1] = chunk ? chunk.tiles[(ty - cy) * chunk.width + (tx - cx)] : -1;
+      }
+    }
+  }
+
   updateMap(frame: FrameUpdateMessage) {
     if (!(frame.id in this.maps)) {
       this.maps[frame.id] = new Array(frame.height);